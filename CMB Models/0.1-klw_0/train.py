@@ -14,6 +14,7 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 '''
 # dataset_path = '../../../Local Data Files/WMAP/Datasets/SkymapK1_9yr_res9_flip_rotate'
 dataset_path = '../../../Local Data Files/WMAP/Datasets/SkymapK1_9yr_res9'
+augment = False  # True -> random flips/rotations applied to each training batch (instead of the _flip_rotate dataset)
 
 stochastic = True  # setting to False makes this deterministic (no sampling) - i.e. a normal autoencoder
 batch_size = 100
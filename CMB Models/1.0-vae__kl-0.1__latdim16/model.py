@@ -126,13 +126,12 @@ class ConvVAE(nn.Module):
     
     def reparameterize(self, mean, variance):
         if self.stochastic:
-            stdev = torch.randn_like(variance).to(device)
+            stdev = torch.randn_like(variance)
             return mean + variance * stdev
         else:
             return mean
 
     def forward(self, x):
-        x = x.to(device)
         mean, variance = self.encoder(x)
         z_sample = self.reparameterize(mean, variance)
         z = self.decoder(z_sample)
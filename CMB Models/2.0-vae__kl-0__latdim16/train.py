@@ -77,7 +77,7 @@ if __name__ == '__main__':
 # train-val split
 n_train = int(train_split_percent*len(whole_dataset))
 n_val = len(whole_dataset) - n_train
-train_subset, val_subset = random_split(whole_dataset, [n_train, n_val], generator=np.random.seed(0))
+train_subset, val_subset = random_split(whole_dataset, [n_train, n_val], generator=torch.Generator().manual_seed(0))
 if __name__ == '__main__':
     print(f"Train dataset size: {len(train_subset)} | Validation dataset size: {len(val_subset)}")
     print(f"Image size: {train_subset[0][0].size()}")
@@ -53,25 +53,24 @@ class ConvVAE(nn.Module):
 
         # reparameterization:
         std = logvar.mul(0.5).exp_()
-        esp = torch.randn(*mu.size()).to(device)
+        esp = torch.randn_like(mu)
         z = mu + std * esp
 
         return z, mu, logvar
 
     def forward(self, x):
-        x = x.to(device)
 
         # encoder
-        h = self.encoder(x).to(device)
+        h = self.encoder(x)
         z, mu, logvar = self.bottleneck(h)
 
         # decoder
         if self.stochastic: # VAEs (stochastic)
             z = self.fc3(z)
-            z = self.decoder(z).to(device)
+            z = self.decoder(z)
         else: # AEs (deterministic)
             z = self.fc3(mu)
-            z = self.decoder(z).to(device)
+            z = self.decoder(z)
 
         return z, mu, logvar
     
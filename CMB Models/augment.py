@@ -0,0 +1,72 @@
+import torch
+
+'''
+On-the-fly augmentation of whole batches, replacing pre-augmented crop directories
+(e.g. SkymapK1_9yr_res9_flip_rotate) that multiply the disk footprint and I/O of a dataset.
+'''
+
+
+class DihedralAugment:
+    '''
+    Applies one of the 8 symmetries of the square (rot90 by k*90 degrees, optionally after a horizontal flip)
+    to every crop of a (B, C, H, W) or (B, H, W) batch, drawn independently per crop.
+    Crops are grouped by transform, so a batch costs at most 8 rot90/flip calls instead of one per crop.
+
+    seed: transforms are drawn from a generator seeded with (seed, epoch), so the transforms of any epoch can be
+          replayed exactly (start_epoch(epoch) and the same batch order). None -> fresh random transforms.
+    replay = True -> every epoch reuses the transforms of epoch 0.
+    '''
+    N_TRANSFORMS = 8
+
+    def __init__(self, seed=None, replay=False):
+        self.seed = seed
+        self.replay = replay
+        self.generator = torch.Generator()
+        self.start_epoch(0)
+
+    def start_epoch(self, epoch):
+        if self.seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(self.seed * 1000003 + (0 if self.replay else epoch))
+
+    def draw(self, n):
+        # transform ids 0..7: rot90 k = id % 4, horizontal flip first if id >= 4
+        return torch.randint(self.N_TRANSFORMS, (n,), generator=self.generator)
+
+    def __call__(self, batch, transforms=None):
+        if batch.shape[-1] != batch.shape[-2]:
+            raise ValueError(f'Dihedral augmentation needs square crops, got {tuple(batch.shape[-2:])}')
+        transforms = self.draw(len(batch)) if transforms is None else torch.as_tensor(transforms)
+        transforms = transforms.to(batch.device)
+        out = torch.empty_like(batch)
+        for t in torch.unique(transforms).tolist():
+            selected = transforms == t
+            crops = batch[selected]
+            if t >= 4:
+                crops = crops.flip(-1)
+            out[selected] = torch.rot90(crops, t % 4, dims=(-2, -1))
+        return out
+
+
+class AugmentedLoader:
+    '''
+    Wraps a DataLoader/TensorLoader and augments every batch it yields. Exposes .dataset and len() like the
+    wrapped loader, so experiment.train uses it unchanged; each pass over it starts a new augmentation epoch.
+    start_epoch: number of epochs already trained (the epoch of the checkpoint a run resumes from), so a resumed
+                 run continues the transform sequence instead of replaying it from epoch 0.
+    '''
+    def __init__(self, loader, augment, start_epoch=0):
+        self.loader = loader
+        self.augment = augment
+        self.dataset = loader.dataset
+        self.epoch = start_epoch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.augment.start_epoch(self.epoch)
+        self.epoch += 1
+        for batch in self.loader:
+            yield self.augment(batch)
@@ -0,0 +1,261 @@
+'''
+I/O benchmarks for the WMAP input pipeline.
+
+usage (from the CMB Models folder):
+    python benchmarks.py store "../../../Local Data Files/WMAP/Datasets/SkymapK1_9yr_res9"
+    python benchmarks.py encoding "../../../Local Data Files/WMAP/Datasets/SkymapK1_9yr_res9.store" \
+        --model-dir 0.0-vae__latdim32 --checkpoint "0.0-vae__latdim32/Checkpoints/<timestamp>/<checkpoint>.pth"
+    python benchmarks.py sampler "../../../Local Data Files/WMAP/Datasets/SkymapK1_9yr_res9.store"
+    python benchmarks.py collate "../../../Local Data Files/WMAP/Datasets/SkymapK1_9yr_res9.store" --normalize
+'''
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import importlib.util
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from datasets import WMAP, ShardShuffleSampler, collate_batch
+from crop_store import default_store_path, build_crop_store, encode_crop_store, ENCODINGS, EncodedCrops, ShardedCrops
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def epoch_time(dataset, batch_size=100, shuffle=True, **loader_kwargs):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **{'collate_fn': collate_batch, **loader_kwargs})
+    start = time.perf_counter()
+    for batch in loader:
+        pass
+    return time.perf_counter() - start
+
+
+def bench_store(dataset_path, n_items=10000, batch_size=100, epochs=1):
+    store_path = default_store_path(dataset_path)
+    _, build_time = timed(build_crop_store, dataset_path, store_path)
+    print(f'Crop store: {store_path} (built/opened in {build_time:.2f}s)')
+
+    files = WMAP(dataset_path, storage='files')
+    store = WMAP(dataset_path, storage='memmap', store_path=store_path)
+    n_items = min(n_items, len(files))
+    order = np.random.default_rng(0).permutation(len(files))[:n_items]
+
+    # per-item reads in random order
+    _, t_files = timed(lambda: [files[i] for i in order])
+    _, t_store = timed(lambda: [store[i] for i in order])
+    print(f'Random item reads ({n_items}): files {n_items / t_files:,.0f}/s | memmap {n_items / t_store:,.0f}/s '
+          f'| speedup {t_files / t_store:.1f}x')
+
+    # whole-batch reads
+    n_batches = n_items // batch_size
+    _, t_files = timed(lambda: [files.get_batch(order[b*batch_size:(b+1)*batch_size]) for b in range(n_batches)])
+    _, t_store = timed(lambda: [store.get_batch(order[b*batch_size:(b+1)*batch_size]) for b in range(n_batches)])
+    print(f'Batch reads ({n_batches} x {batch_size}): files {n_batches * batch_size / t_files:,.0f} crops/s '
+          f'| memmap {n_batches * batch_size / t_store:,.0f} crops/s')
+
+    # full epochs through a DataLoader, as in generic_trainer.py
+    for epoch in range(1, epochs + 1):
+        t_files = epoch_time(files, batch_size)
+        t_store = epoch_time(store, batch_size)
+        print(f'Epoch {epoch} wall time ({len(files)} crops): files {t_files:.2f}s | memmap {t_store:.2f}s '
+              f'| speedup {t_files / t_store:.1f}x')
+
+
+def crop_bytes(crops):
+    # on-disk size of a store's crop data (plus the per-crop affine parameters of uint16 stores)
+    if isinstance(crops, EncodedCrops):
+        return crops.crops.nbytes + (0 if crops.affine is None else crops.affine.nbytes)
+    if isinstance(crops, ShardedCrops):
+        return sum(shard.nbytes for shard in crops.shards)
+    return crops.nbytes
+
+
+def load_model(model_dir, checkpoint=None):
+    # the model built by a model folder's train.py (like functions.GetModelImages), made deterministic
+    # (no sampling in the bottleneck) so that only the inputs change the loss
+    cwd, model_dir = os.getcwd(), os.path.abspath(model_dir)
+    sys.path.insert(0, model_dir)  # for its model.py
+    os.chdir(model_dir)  # train.py uses paths relative to its folder
+    try:
+        spec = importlib.util.spec_from_file_location('train', 'train.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(model_dir)
+    model = module.get_model().cpu()
+    if checkpoint:
+        state = torch.load(checkpoint, map_location='cpu')
+        model.load_state_dict(state.get('state_dict', state))
+    model.stochastic = False
+    return model.eval()
+
+
+def bench_encoding(store_path, model_dir=None, checkpoint=None, n_items=10000, batch_size=100, normalize=False):
+    torch.manual_seed(0)
+    reference = WMAP(store_path, storage='memmap', normalize=normalize)
+    n_items = min(n_items, len(reference))
+    order = np.sort(np.random.default_rng(0).permutation(len(reference))[:n_items])
+    batches = [order[b:b + batch_size] for b in range(0, n_items, batch_size)]
+    model = load_model(model_dir, checkpoint) if model_dir else None
+
+    def losses(dataset):
+        x = [dataset.__getitems__(batch.tolist()).tensor for batch in batches]
+        if model is None:
+            return x, None
+        with torch.no_grad():
+            return x, [torch.nn.functional.mse_loss(model(b)[0].cpu(), b).item() for b in x]
+
+    ref_x, ref_losses = losses(reference)
+    print(f'{"encoding":>9} | {"size":>9} | {"read":>13} | {"max abs err":>11} | loss drift vs float32')
+    for encoding in ENCODINGS:
+        path = store_path if encoding == 'float32' else f'{os.path.normpath(store_path)}.{encoding}'
+        if encoding != 'float32' and not os.path.isfile(os.path.join(path, 'index.json')):
+            encode_crop_store(store_path, path, encoding)
+        dataset = WMAP(path, storage='memmap', normalize=normalize)
+        _, t_read = timed(lambda: [dataset.get_batch(batch) for batch in batches])
+        x, enc_losses = losses(dataset)
+        error = max((a - b).abs().max().item() for a, b in zip(x, ref_x))
+        drift = 'n/a (no --model-dir)' if model is None else \
+            f'{np.mean(enc_losses):.6g} vs {np.mean(ref_losses):.6g} ' \
+            f'(max per-batch rel. drift {np.max(np.abs(np.subtract(enc_losses, ref_losses)) / np.abs(ref_losses)):.2e})'
+        print(f'{encoding:>9} | {crop_bytes(dataset.crops) / 2**20:7.1f}MB | {n_items / t_read:9,.0f}/s | {error:11.3g} | {drift}')
+
+
+def evict_page_cache(path):
+    # drop the files' pages from the OS page cache (linux), so the next epoch really reads from disk
+    for root, _, files in os.walk(path):
+        for name in files:
+            fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def bench_sampler(store_path, batch_size=100, epochs=1, buffer_size=16384, train_fraction=0.8, cold=True):
+    from splits import split_dataset
+    dataset = WMAP(store_path, storage='memmap')
+    train_subset, _ = split_dataset(dataset, train_fraction)
+    loaders = {'shuffle=True': DataLoader(train_subset, batch_size=batch_size, shuffle=True, collate_fn=collate_batch),
+               'ShardShuffleSampler': DataLoader(train_subset, batch_size=batch_size, collate_fn=collate_batch,
+                                                 sampler=ShardShuffleSampler(train_subset, buffer_size=buffer_size))}
+    store_indices = np.asarray(train_subset.indices)
+    shard_of = dataset.crops.shard_of if isinstance(dataset.crops, ShardedCrops) else lambda i: i // 65536
+    crop_bytes = np.prod(dataset.crops.shape[1:]) * dataset.crops.dtype.itemsize
+    cache = 'cold page cache' if cold and hasattr(os, 'posix_fadvise') else 'warm page cache'
+
+    for name, loader in loaders.items():
+        for epoch in range(1, epochs + 1):
+            if cold and hasattr(os, 'posix_fadvise'):
+                evict_page_cache(store_path)
+            start = time.perf_counter()
+            for batch in loader:
+                pass
+            t = time.perf_counter() - start
+            print(f'{name:>19} | epoch {epoch} ({cache}): {len(train_subset) / t:,.0f} crops/s '
+                  f'({len(train_subset) * crop_bytes / t / 2**20:,.1f} MB/s)')
+        # batch composition: how many shards and how far apart in the store the crops of a batch are
+        positions = np.array(list(loader.sampler))[:(len(train_subset) // batch_size) * batch_size]
+        batches = store_indices[positions].reshape(-1, batch_size)
+        shards = np.mean([len(np.unique(shard_of(batch))) for batch in batches])
+        spread = np.mean(batches.max(axis=1) - batches.min(axis=1))
+        print(f'{"":>19} | {shards:.1f} shards per batch, batch spans {spread:,.0f} crops of the store on average')
+
+
+def step_allocations(loader, steps, device, image_shape, warmup=5):
+    # per training-loop input step (next batch, view to (B, C, H, W), transfer to the device): torch tensor
+    # allocations (count, bytes) and transient numpy memory (e.g. fancy-indexed memmap reads), in separate passes
+    batches = iter(loader)
+
+    def step():
+        batch = next(batches)
+        return batch.view(batch.size(0), *image_shape).to(device, non_blocking=True)
+
+    for _ in range(warmup):
+        step()  # fills the buffer ring, page cache
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        for _ in range(steps):
+            step()
+    allocations = [event.self_cpu_memory_usage for event in prof.events() if event.self_cpu_memory_usage > 0]
+
+    tracemalloc.start()
+    numpy_bytes = 0
+    for _ in range(steps):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        step()
+        numpy_bytes += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return len(allocations) / steps, sum(allocations) / steps, numpy_bytes / steps
+
+
+def bench_collate(store_path, batch_size=100, steps=200, normalize=False, device='cpu'):
+    for name, buffers in [('fresh tensor per batch', False), ('preallocated buffers', True)]:
+        dataset = WMAP(store_path, normalize=normalize, storage='memmap')
+        if buffers:
+            dataset.use_batch_buffers()
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_batch)
+        image_shape = dataset[0].shape
+        count, allocated, numpy_bytes = step_allocations(loader, min(steps, (len(loader) - 5) // 2), device,
+                                                         image_shape)
+        start = time.perf_counter()
+        for batch in loader:
+            batch.view(batch.size(0), *image_shape).to(device, non_blocking=True)
+        t = time.perf_counter() - start
+        print(f'{name:>22} | {count:5.1f} tensor allocations/step ({allocated / 2**10:8.1f}KB) '
+              f'| numpy {numpy_bytes / 2**10:8.1f}KB/step | {len(dataset) / t:,.0f} crops/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    store_parser = subparsers.add_parser('store', help='per-file np.load vs consolidated memmap crop store')
+    store_parser.add_argument('dataset_path')
+    store_parser.add_argument('--n-items', type=int, default=10000)
+    store_parser.add_argument('--batch-size', type=int, default=100)
+    store_parser.add_argument('--epochs', type=int, default=1)
+
+    encoding_parser = subparsers.add_parser('encoding', help='compact crop store encodings vs float32: size, read '
+                                                             'speed, crop error and reconstruction-loss drift')
+    encoding_parser.add_argument('store_path', help='float32 crop store; encoded copies are written next to it')
+    encoding_parser.add_argument('--model-dir', default=None, help='model folder (its train.py builds the model)')
+    encoding_parser.add_argument('--checkpoint', default=None, help='checkpoint / state dict of that model')
+    encoding_parser.add_argument('--n-items', type=int, default=10000)
+    encoding_parser.add_argument('--batch-size', type=int, default=100)
+    encoding_parser.add_argument('--normalize', action='store_true')
+
+    sampler_parser = subparsers.add_parser('sampler', help='DataLoader(shuffle=True) vs ShardShuffleSampler epochs')
+    sampler_parser.add_argument('store_path')
+    sampler_parser.add_argument('--batch-size', type=int, default=100)
+    sampler_parser.add_argument('--epochs', type=int, default=1)
+    sampler_parser.add_argument('--buffer-size', type=int, default=16384)
+    sampler_parser.add_argument('--warm', action='store_true', help="don't evict the store from the page cache")
+
+    collate_parser = subparsers.add_parser('collate', help='allocations per training step: fresh batch tensors vs '
+                                                           'preallocated batch buffers')
+    collate_parser.add_argument('store_path')
+    collate_parser.add_argument('--batch-size', type=int, default=100)
+    collate_parser.add_argument('--steps', type=int, default=200)
+    collate_parser.add_argument('--normalize', action='store_true')
+    collate_parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+
+    args = parser.parse_args()
+    if args.benchmark == 'store':
+        bench_store(args.dataset_path, n_items=args.n_items, batch_size=args.batch_size, epochs=args.epochs)
+    elif args.benchmark == 'encoding':
+        bench_encoding(args.store_path, model_dir=args.model_dir, checkpoint=args.checkpoint, n_items=args.n_items,
+                       batch_size=args.batch_size, normalize=args.normalize)
+    elif args.benchmark == 'sampler':
+        bench_sampler(args.store_path, batch_size=args.batch_size, epochs=args.epochs, buffer_size=args.buffer_size,
+                      cold=not args.warm)
+    elif args.benchmark == 'collate':
+        bench_collate(args.store_path, batch_size=args.batch_size, steps=args.steps, normalize=args.normalize,
+                      device=args.device)
@@ -0,0 +1,226 @@
+'''
+Builds a crop store (see crop_store.py) directly from WMAP sky map FITS files.
+
+Every source map gets its own shard (<store>/shards/<map>-<key>.npy), keyed by a hash of the map's content and of
+the crop parameters (crop size, stride, mask content, NaN / ellipse masking, HDU). Re-running the builder only cuts
+the shards whose key changed - a modified map, a new map (e.g. adding Ka1 next to K1) or new parameters - and reuses
+the rest.
+
+Within a shard, tile positions are computed up front (deterministic: same inputs -> same crops in the same order),
+split into fixed chunks and cut by a process pool. Every worker memory-maps the cached map (float32, converted once
+from the FITS file, see skymaps.py) and the output shard itself and writes its chunk in place, so the result does
+not depend on the number of workers or on scheduling.
+Finished chunks are recorded next to the shard, so an interrupted build resumes where it stopped.
+The galactic coordinates of every crop (<store>/sky.npy) are looked up in the maps' projection tables
+(see projection.py), computed once per map resolution.
+
+usage (from the CMB Models folder):
+    python crop_builder.py "../../../Local Data Files/WMAP/Datasets/SkymapK1_9yr_res9.store" \
+        "../../../Local Data Files/WMAP/Single Year Temperature Res 9 Sky Maps Per Differencing Assembly/"*K1_v5.fits \
+        --crop-size 28 --stride 28
+'''
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from crop_store import INDEX_FILE, POSITIONS_FILE, SKY_FILE, build_crop_pyramid
+from skymaps import SkyMap, tile_positions, file_hash, load_mask, valid_pixels
+
+SHARDS_DIR = 'shards'
+
+# FITS maps opened by this (worker) process, kept open across chunks
+_maps = {}
+
+
+def worker_map(path, hdu):
+    if (path, hdu) not in _maps:
+        _maps[(path, hdu)] = SkyMap(path, hdu)
+    return _maps[(path, hdu)]
+
+
+def cut_chunk(partial_path, map_file, hdu, crop_size, positions, start):
+    out = np.load(partial_path, mmap_mode='r+')
+    out[start:start + len(positions)] = worker_map(map_file, hdu).crops(positions[:, 0], positions[:, 1], crop_size)
+    out.flush()
+    return partial_path, [start, start + len(positions)]
+
+
+def write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def shard_key(map_hash, params):
+    key = json.dumps({'map': map_hash, **params}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def build_store_from_maps(map_files, store_path, crop_size=28, stride=None, mask=None, hdu=1,
+                          workers=None, chunk_size=4096, prune=True, mask_nan=False, mask_ellipse=False, pyramid=()):
+    '''
+    mask: optional path to a boolean .npy array (same shape as the maps) of valid pixels, e.g. the projection
+          ellipse and/or a galactic band cut; tiles that contain an invalid pixel are never cut.
+    mask_nan: also treat each map's NaN pixels as invalid (instead of cutting them as zeros).
+    mask_ellipse: also treat pixels outside the Mollweide projection ellipse as invalid (from the projection tables,
+                  for maps that are zero rather than NaN off the sky).
+    prune: delete cached shards that the new index no longer uses.
+    pyramid: downsampling factors (e.g. (2, 4)) of block-mean pyramid levels to build for coarse-to-fine training.
+    '''
+    map_files = [os.path.abspath(path) for path in map_files]
+    params = {'crop_size': crop_size,
+              'stride': stride or crop_size,
+              'mask': file_hash(mask) if mask else None,
+              'hdu': hdu}
+    if mask_nan:
+        params['mask_nan'] = True  # only in the key when set, so shards cut before the option existed stay valid
+    if mask_ellipse:
+        params['mask_ellipse'] = True
+    mask_array = load_mask(mask)
+
+    shards_path = os.path.join(store_path, SHARDS_DIR)
+    os.makedirs(shards_path, exist_ok=True)
+
+    shards, todo = [], []
+    for path in map_files:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name = f'{stem}-{shard_key(file_hash(path), params)}'
+        shard = {'file': f'{SHARDS_DIR}/{name}.npy', 'map': path}
+        shards.append(shard)
+        if not os.path.isfile(os.path.join(store_path, shard['file'])):
+            todo.append(shard)
+    print(f'{len(shards) - len(todo)}/{len(shards)} shards up to date, cutting {len(todo)}.')
+
+    # ========================== cut the missing shards ==========================
+    tasks = []
+    for shard in todo:
+        sky_map = SkyMap(shard['map'], hdu)
+        shard_mask = valid_pixels(sky_map, mask_array, mask_nan)
+        if mask_ellipse:
+            ellipse = np.asarray(sky_map.projection().valid)
+            shard_mask = ellipse if shard_mask is None else shard_mask & ellipse
+        ys, xs = tile_positions(sky_map.shape, crop_size, stride, shard_mask)
+        sky_map.close()
+        positions = np.stack([ys, xs], axis=1).astype(np.int32)
+        np.save(os.path.join(store_path, shard['file'][:-len('.npy')] + '.positions.npy'), positions)
+
+        partial_path = os.path.join(store_path, shard['file'] + '.partial')
+        build_path = os.path.join(store_path, shard['file'] + '.build.json')
+        done = []
+        if os.path.isfile(build_path) and os.path.isfile(partial_path):
+            with open(build_path) as f:
+                done = json.load(f)['done']
+            # [start, stop) ranges of the finished chunks (older builds only recorded starts, without the chunk size)
+            if not all(isinstance(chunk, list) for chunk in done):
+                print(f"Restarting {shard['file']}: its build record has no chunk ranges.")
+                done = []
+            else:
+                print(f"Resuming {shard['file']}: {len(done)} chunks already cut.")
+        if not done:
+            np.lib.format.open_memmap(partial_path, mode='w+', dtype=np.float32,
+                                      shape=(len(positions), crop_size, crop_size))
+        # crops already cut, so resuming with a different chunk size only skips chunks that are entirely done
+        cut = np.zeros(len(positions) + 1, dtype=np.int64)
+        for chunk_start, chunk_stop in done:
+            cut[chunk_start] += 1
+            cut[chunk_stop] -= 1
+        cut = np.cumsum(cut[:-1]) > 0
+        shard.update(partial=partial_path, build=build_path, done=done, remaining=0)
+        for start in range(0, len(positions), chunk_size):
+            if not cut[start:start + chunk_size].all():
+                tasks.append((partial_path, shard['map'], hdu, crop_size, positions[start:start + chunk_size], start))
+                shard['remaining'] += 1
+        if shard['remaining'] == 0:
+            os.replace(partial_path, os.path.join(store_path, shard['file']))
+
+    by_partial = {shard['partial']: shard for shard in todo}
+    start_time = time.time()
+    if tasks:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(cut_chunk, *task) for task in tasks]
+            for n, future in enumerate(as_completed(futures), start=1):
+                partial_path, chunk = future.result()
+                shard = by_partial[partial_path]
+                shard['done'].append(chunk)
+                shard['remaining'] -= 1
+                write_json(shard['build'], {'done': shard['done']})
+                if shard['remaining'] == 0:
+                    os.replace(partial_path, os.path.join(store_path, shard['file']))
+                    os.remove(shard['build'])
+                print(f'\rCut {n}/{len(tasks)} chunks ({time.time() - start_time:.1f}s)', end='', flush=True)
+        print()
+
+    # ========================== index over all shards ==========================
+    names, positions = [], []
+    for i, shard in enumerate(shards):
+        shard['positions'] = np.load(os.path.join(store_path, shard['file'][:-len('.npy')] + '.positions.npy'))
+        stem = os.path.splitext(os.path.basename(shard['map']))[0]
+        names += [f'{stem}__y{y}_x{x}' for y, x in shard['positions'].tolist()]
+        positions.append(np.column_stack([np.full(len(shard['positions']), i), shard['positions']]))
+        shard['count'] = len(shard['positions'])
+    positions = np.concatenate(positions).astype(np.int32)
+    if len(positions) == 0:
+        raise ValueError('No valid crop positions in the given maps')
+
+    index = {'names': names,
+             'shape': [len(positions), crop_size, crop_size],
+             'dtype': np.dtype(np.float32).str,
+             'source': None,
+             'sources': map_files,
+             'shards': [{'file': shard['file'], 'count': shard['count']} for shard in shards],
+             'params': params}
+    # the stats catalog, pyramid levels and aligned-* caches are keyed on the index.json mtime,
+    # so a rebuild that changed nothing leaves the index (and everything derived from it) untouched
+    index_path = os.path.join(store_path, INDEX_FILE)
+    try:
+        with open(index_path) as f:
+            unchanged = json.load(f) == index
+    except FileNotFoundError:
+        unchanged = False
+    unchanged = unchanged and all(os.path.isfile(os.path.join(store_path, f)) for f in (POSITIONS_FILE, SKY_FILE))
+    if not unchanged:
+        sky = []
+        for shard in shards:
+            sky_map = SkyMap(shard['map'], hdu)
+            sky.append(np.column_stack(sky_map.projection().crop_centers(*shard['positions'].T, crop_size)))
+            sky_map.close()
+        np.save(os.path.join(store_path, POSITIONS_FILE), positions)
+        np.save(os.path.join(store_path, SKY_FILE), np.concatenate(sky).astype(np.float32))
+        write_json(index_path, index)
+
+    if prune:
+        used = {os.path.basename(shard['file'])[:-len('.npy')] for shard in shards}
+        for f in os.listdir(shards_path):
+            if not any(f.startswith(name + '.') for name in used):
+                os.remove(os.path.join(shards_path, f))
+    if pyramid:
+        build_crop_pyramid(store_path, factors=pyramid)
+    return store_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('store_path', help='output crop store directory')
+    parser.add_argument('map_files', nargs='+', help='WMAP sky map FITS files')
+    parser.add_argument('--crop-size', type=int, default=28)
+    parser.add_argument('--stride', type=int, default=None, help='pixels between crops (default: crop size)')
+    parser.add_argument('--mask', default=None, help='boolean .npy array of valid pixels, same shape as the maps')
+    parser.add_argument('--mask-nan', action='store_true', help="also skip tiles containing the maps' NaN pixels")
+    parser.add_argument('--mask-ellipse', action='store_true',
+                        help='also skip tiles reaching outside the projection ellipse')
+    parser.add_argument('--hdu', type=int, default=1, help='HDU holding the map image')
+    parser.add_argument('--workers', type=int, default=None, help='processes (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=4096, help='crops per task')
+    parser.add_argument('--pyramid', type=int, nargs='*', default=(), help='also build downsampled levels, e.g. 2 4')
+    parser.add_argument('--keep-stale-shards', action='store_true', help="don't delete shards the index no longer uses")
+    args = parser.parse_args()
+
+    build_store_from_maps(sorted(args.map_files), args.store_path, crop_size=args.crop_size, stride=args.stride,
+                          mask=args.mask, hdu=args.hdu, workers=args.workers, chunk_size=args.chunk_size,
+                          prune=not args.keep_stale_shards, mask_nan=args.mask_nan, mask_ellipse=args.mask_ellipse,
+                          pyramid=args.pyramid)
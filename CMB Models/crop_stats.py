@@ -0,0 +1,204 @@
+'''
+Per-crop statistics catalog of a crop store (see crop_store.py), computed once by a process pool
+instead of looping over the crops by hand.
+
+layout (columnar, one memory-mappable .npy per column):
+    <store>/stats/<column>.npy - one value per crop, in store order, for every column in STATS_COLUMNS
+    <store>/stats/meta.json    - crop count and index.json mtime of the store the catalog was computed from
+                                 (written last, a catalog without it is incomplete)
+
+usage (from the CMB Models folder):
+    python crop_stats.py "../../../Local Data Files/WMAP/Datasets/SkymapK1_9yr_res9.store"
+    python crop_stats.py "../../../Local Data Files/WMAP/Datasets/SkymapK1_9yr_res9.store" --query "unique_values > 50"
+'''
+import os
+import ast
+import json
+import operator
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from crop_store import INDEX_FILE, POSITIONS_FILE, SKY_FILE, open_crop_store
+
+STATS_DIR = 'stats'
+META_FILE = 'meta.json'
+
+# min/max/mean/std ignore NaN pixels; map_idx/y/x are -1 and l/b (galactic coordinates of the crop centre, degrees)
+# are NaN for stores that weren't cut from sky maps
+STATS_COLUMNS = {'min': np.float32,
+                 'max': np.float32,
+                 'mean': np.float32,
+                 'std': np.float32,
+                 'unique_values': np.int32,
+                 'nan_fraction': np.float32,
+                 'zero_fraction': np.float32,
+                 'map_idx': np.int32,
+                 'y': np.int32,
+                 'x': np.int32,
+                 'l': np.float32,
+                 'b': np.float32}
+
+
+def crop_stats(crops):
+    # statistics of a (N, H, W) chunk of crops, vectorized over the chunk
+    flat = np.asarray(crops, dtype=np.float32).reshape(len(crops), -1)
+    nan = np.isnan(flat)
+    any_valid = ~nan.all(axis=1)
+    filled = np.where(nan, 0, flat)
+    n_valid = np.maximum((~nan).sum(axis=1), 1)
+    mean = filled.sum(axis=1) / n_valid
+    std = np.sqrt(np.where(nan, 0, (flat - mean[:, None]) ** 2).sum(axis=1) / n_valid)
+    ordered = np.sort(flat, axis=1)  # NaNs sort last
+    distinct = (np.diff(ordered, axis=1) != 0) & ~np.isnan(ordered[:, 1:])
+    return {'min': np.where(any_valid, np.where(nan, np.inf, flat).min(axis=1), np.nan),
+            'max': np.where(any_valid, np.where(nan, -np.inf, flat).max(axis=1), np.nan),
+            'mean': np.where(any_valid, mean, np.nan),
+            'std': np.where(any_valid, std, np.nan),
+            'unique_values': distinct.sum(axis=1) + any_valid,
+            'nan_fraction': nan.mean(axis=1),
+            'zero_fraction': (flat == 0).mean(axis=1)}
+
+
+def stats_chunk(store_path, start, stop):
+    crops, _ = open_crop_store(store_path, mmap_mode='r')
+    return start, crop_stats(crops[start:stop])
+
+
+def stats_path(store_path):
+    return os.path.join(store_path, STATS_DIR)
+
+
+def index_mtime(store_path):
+    return os.stat(os.path.join(store_path, INDEX_FILE)).st_mtime
+
+
+def build_crop_stats(store_path, workers=None, chunk_size=16384, overwrite=False):
+    stats = load_crop_stats(store_path)
+    if stats is not None and not overwrite:
+        return stats
+
+    crops, index = open_crop_store(store_path, mmap_mode='r')
+    n = len(crops)
+    path = stats_path(store_path)
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, META_FILE)
+    if os.path.isfile(meta_path):
+        os.remove(meta_path)
+
+    columns = {name: np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=dtype, shape=(n,))
+               for name, dtype in STATS_COLUMNS.items()}
+    positions_path = os.path.join(store_path, POSITIONS_FILE)
+    if index.get('sources') and os.path.isfile(positions_path):
+        positions = np.load(positions_path)
+        columns['map_idx'][:], columns['y'][:], columns['x'][:] = positions.T
+    else:
+        columns['map_idx'][:] = columns['y'][:] = columns['x'][:] = -1
+    sky_path = os.path.join(store_path, SKY_FILE)
+    if os.path.isfile(sky_path):
+        columns['l'][:], columns['b'][:] = np.load(sky_path).T
+    else:
+        columns['l'][:] = columns['b'][:] = np.nan
+
+    start_time = time.time()
+    starts = range(0, n, chunk_size)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(stats_chunk, store_path, start, start + chunk_size) for start in starts]
+        for done, future in enumerate(as_completed(futures), start=1):
+            start, chunk = future.result()
+            for name, values in chunk.items():
+                columns[name][start:start + len(values)] = values
+            print(f'\rScanned {done}/{len(starts)} chunks ({time.time() - start_time:.1f}s)', end='', flush=True)
+    print()
+
+    for column in columns.values():
+        column.flush()
+    del columns
+    with open(meta_path, 'w') as f:
+        json.dump({'count': n, 'index_mtime': index_mtime(store_path)}, f)
+    return load_crop_stats(store_path)
+
+
+def load_crop_stats(store_path, mmap_mode='r'):
+    '''
+    Dict of column name -> (N,) array for the store's catalog, or None if it hasn't been built
+    (or was computed from an older version of the store).
+    '''
+    path = stats_path(store_path)
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta['index_mtime'] != index_mtime(store_path):
+        return None
+    if not all(os.path.isfile(os.path.join(path, f'{name}.npy')) for name in STATS_COLUMNS):
+        return None  # catalog from before a column was added
+    return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in STATS_COLUMNS}
+
+
+QUERY_OPERATORS = {ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Lt: operator.lt, ast.LtE: operator.le,
+                   ast.Eq: operator.eq, ast.NotEq: operator.ne,
+                   ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+                   ast.USub: operator.neg}
+
+
+def evaluate_query(node, stats):
+    # element-wise evaluation of a parsed query over the catalog columns (no eval: only the nodes below are allowed)
+    if isinstance(node, ast.Expression):
+        return evaluate_query(node.body, stats)
+    if isinstance(node, ast.BoolOp):
+        combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+        values = [evaluate_query(value, stats) for value in node.values]
+        result = values[0]
+        for value in values[1:]:
+            result = combine(result, value)
+        return result
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return np.logical_not(evaluate_query(node.operand, stats))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in QUERY_OPERATORS:
+        return QUERY_OPERATORS[type(node.op)](evaluate_query(node.operand, stats))
+    if isinstance(node, ast.BinOp) and type(node.op) in QUERY_OPERATORS:
+        return QUERY_OPERATORS[type(node.op)](evaluate_query(node.left, stats), evaluate_query(node.right, stats))
+    if isinstance(node, ast.Compare) and all(type(op) in QUERY_OPERATORS for op in node.ops):
+        # chained comparisons (0.1 < std < 2) like python's: every pair must hold
+        result, left = True, evaluate_query(node.left, stats)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = evaluate_query(comparator, stats)
+            result = np.logical_and(result, QUERY_OPERATORS[type(op)](left, right))
+            left = right
+        return result
+    if isinstance(node, ast.Name):
+        if node.id not in stats:
+            raise ValueError(f"Unknown column '{node.id}' in crop query, expected one of {list(stats)}")
+        return np.asarray(stats[node.id])
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    raise ValueError(f"Unsupported expression in crop query: '{ast.unparse(node)}'")
+
+
+def query_crop_stats(stats, query):
+    '''
+    Sorted indices of the crops matching a query over the catalog columns, e.g.
+    'unique_values > 50 and std > 1e-3', 'not (zero_fraction > 0.5 or nan_fraction > 0)', 'b > 30 or b < -30'
+    '''
+    mask = np.broadcast_to(evaluate_query(ast.parse(query, mode='eval'), stats), np.shape(stats['min']))
+    return np.flatnonzero(mask)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('store_path', help='crop store directory (see crop_store.py / crop_builder.py)')
+    parser.add_argument('--workers', type=int, default=None, help='processes (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=16384, help='crops per task')
+    parser.add_argument('--overwrite', action='store_true', help='recompute an existing up-to-date catalog')
+    parser.add_argument('--query', default=None, help='also report how many crops match this query')
+    args = parser.parse_args()
+
+    stats = build_crop_stats(args.store_path, workers=args.workers, chunk_size=args.chunk_size,
+                             overwrite=args.overwrite)
+    print(f"{len(stats['min'])} crops | constant crops (1 unique value): {int(np.sum(stats['unique_values'] <= 1))} "
+          f"| median unique values: {np.median(stats['unique_values']):.0f}")
+    if args.query:
+        print(f"'{args.query}': {len(query_crop_stats(stats, args.query))} matching crops")
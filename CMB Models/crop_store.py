@@ -0,0 +1,543 @@
+import os
+import re
+import json
+import time
+import hashlib
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+'''
+A crop store packs a directory of single-crop .npy files into one contiguous array so that
+reading a crop (or a whole batch of crops) is a slice of a memory map instead of an open/read/close.
+
+layout:
+    <store>/crops.npy    - (N, H, W) array in .npy format, readable with np.load(mmap_mode=...)
+    <store>/index.json   - crop names (same order as crops.npy), shape, dtype and source directory
+    <store>/positions.npy - (N, 3) int32 (map index, row, col) of each crop, for stores cut from sky maps
+                            by crop_builder.py (the map files are listed in index.json under 'sources')
+    <store>/sky.npy      - (N, 2) float32 galactic (l, b) in degrees of each crop's centre pixel, for stores cut
+                            from sky maps (looked up in the maps' projection tables, see projection.py)
+    <store>/affine.npy   - (N, 2) float32 (offset, scale) of each crop, for 'uint16' encoded stores
+    <store>/pyramid/<f>x.npy - optional (N, H/f, W/f) float32 block means of the crops (f = 2, 4, ...), for
+                            coarse-to-fine training (see build_crop_pyramid, WMAP.set_resolution)
+
+Crops can be stored in a compact encoding (index.json 'encoding', see ENCODINGS): float16, bfloat16 (the upper half of
+a float32, kept as uint16 since numpy has no bfloat16) or uint16 with a per-crop affine map of the crop's min..max
+range onto 0..65535. They are decoded to float32 batch-wise when read (EncodedCrops), so datasets see float32 crops.
+
+Stores cut by crop_builder.py keep one shard per source map instead of a single crops.npy
+(<store>/shards/*.npy, listed in index.json under 'shards'); they are read through ShardedCrops,
+which indexes like one (N, H, W) array.
+
+A crop directory also gets a manifest (<dataset>.manifest.npy, next to the directory) listing every crop
+in sorted order with its byte size, shape, dtype and mtime, so datasets don't have to os.listdir + stat
+the whole directory on every run and the crop order no longer depends on the filesystem.
+'''
+
+CROPS_FILE = 'crops.npy'
+INDEX_FILE = 'index.json'
+POSITIONS_FILE = 'positions.npy'
+SKY_FILE = 'sky.npy'
+AFFINE_FILE = 'affine.npy'
+PYRAMID_DIR = 'pyramid'
+
+# encoding -> on-disk dtype
+ENCODINGS = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.uint16, 'uint16': np.uint16}
+
+
+def default_store_path(dataset_path):
+    # stores live next to the crop directory, e.g. SkymapK1_9yr_res9 -> SkymapK1_9yr_res9.store
+    return os.path.normpath(dataset_path) + '.store'
+
+
+def is_crop_store(path):
+    # index.json is always written last, once the crop data is complete
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def manifest_dtype(name_length):
+    return [('name', f'U{max(name_length, 1)}'), ('size', 'i8'), ('shape', 'U32'), ('dtype', 'U16'), ('mtime', 'f8')]
+
+
+def manifest_path(dataset_path):
+    return os.path.normpath(dataset_path) + '.manifest.npy'
+
+
+def read_npy_header(path):
+    # shape and dtype of a .npy file without reading its data
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype
+
+
+def manifest_entry(dataset_path, name):
+    path = os.path.join(dataset_path, name)
+    stat = os.stat(path)
+    shape, dtype = read_npy_header(path)
+    return (name, stat.st_size, ','.join(map(str, shape)), dtype.str, stat.st_mtime)
+
+
+def entry_shape(entry):
+    return tuple(int(n) for n in entry['shape'].split(',') if n)
+
+
+def load_manifest(dataset_path, refresh=True, rebuild=False):
+    '''
+    Sorted manifest of the crops (.npy files) in dataset_path, as a structured array with the fields of
+    manifest_dtype(). The cached manifest is reused as long as the directory hasn't been modified since it
+    was written; otherwise only the added files are stat-ed/read and removed files are dropped.
+    Note that overwriting an existing crop in place does not change the directory mtime (use rebuild=True).
+    '''
+    path = manifest_path(dataset_path)
+    manifest = None
+    if os.path.isfile(path) and not rebuild:
+        manifest = np.load(path)
+        if not refresh or os.stat(dataset_path).st_mtime < os.stat(path).st_mtime:
+            return manifest
+
+    listed_at = time.time()
+    # scandir gets the file type from the directory listing itself, without a stat per entry
+    with os.scandir(dataset_path) as entries:
+        names = sorted(entry.name for entry in entries if entry.name.endswith('.npy') and entry.is_file())
+
+    dtype = manifest_dtype(max(map(len, names), default=1))
+    if manifest is None:
+        manifest = np.array([manifest_entry(dataset_path, name) for name in names], dtype=dtype)
+    else:
+        # keep the entries of files that are still there and only read the headers of new files
+        kept = manifest[np.isin(manifest['name'], names)].astype(dtype)
+        new_names = sorted(set(names).difference(kept['name'].tolist()))
+        added = np.array([manifest_entry(dataset_path, name) for name in new_names], dtype=dtype)
+        manifest = np.sort(np.concatenate([kept, added]), order='name')
+
+    try:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, manifest)
+        os.replace(tmp_path, path)
+        # stamp the manifest with the listing time so files added during the listing trigger a refresh
+        os.utime(path, (listed_at, listed_at))
+    except OSError as e:
+        print(f"Could not write crop manifest '{path}': {e}")
+
+    return manifest
+
+
+def list_crop_files(dataset_path):
+    # sorted so that the store order (and anything indexed by it) does not depend on the filesystem
+    return load_manifest(dataset_path)['name'].tolist()
+
+
+def encode_crops(crops, encoding):
+    '''
+    (N, H, W) float crops -> (encoded crops, (N, 2) float32 (offset, scale) per crop or None).
+    Vectorized over the batch; the inverse is decode_crops.
+    '''
+    crops = np.asarray(crops, dtype=np.float32)
+    if encoding == 'float32':
+        return crops, None
+    if encoding == 'float16':
+        return crops.astype(np.float16), None
+    if encoding == 'bfloat16':
+        # round to nearest even on the 16 dropped mantissa bits
+        bits = crops.view(np.uint32).astype(np.uint64)
+        return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16), None
+    if encoding == 'uint16':
+        flat = crops.reshape(len(crops), -1)
+        offset, top = np.nanmin(flat, axis=1), np.nanmax(flat, axis=1)
+        scale = (top - offset) / 65535
+        affine = np.stack([offset, scale], axis=1).astype(np.float32)
+        levels = (crops - offset[:, None, None]) / np.where(scale > 0, scale, 1)[:, None, None]
+        return np.rint(np.nan_to_num(levels)).clip(0, 65535).astype(np.uint16), affine
+    raise ValueError(f"Unknown crop encoding '{encoding}', expected one of {list(ENCODINGS)}")
+
+
+def decode_crops(encoded, encoding, affine=None):
+    # encoded crops (any leading shape) -> float32; affine: (offset, scale) rows matching the leading axis
+    if encoding in ('float32', 'float16'):
+        return np.asarray(encoded, dtype=np.float32)
+    if encoding == 'bfloat16':
+        return (np.asarray(encoded).astype(np.uint32) << 16).view(np.float32)
+    if encoding == 'uint16':
+        affine = np.asarray(affine, dtype=np.float32)
+        shape = affine.shape[:-1] + (1,) * (np.ndim(encoded) - affine.ndim + 1)
+        return np.asarray(encoded, dtype=np.float32) * affine[..., 1].reshape(shape) + affine[..., 0].reshape(shape)
+    raise ValueError(f"Unknown crop encoding '{encoding}', expected one of {list(ENCODINGS)}")
+
+
+def build_crop_store(dataset_path, store_path=None, names=None, overwrite=False, encoding='float32'):
+    store_path = store_path or default_store_path(dataset_path)
+    if is_crop_store(store_path) and not overwrite:
+        return store_path
+
+    names = list_crop_files(dataset_path) if names is None else list(names)
+    if len(names) == 0:
+        raise ValueError(f"No crop files found in '{dataset_path}'")
+
+    first = np.load(os.path.join(dataset_path, names[0]))
+    os.makedirs(store_path, exist_ok=True)
+
+    # write to a temporary file first so an interrupted build never looks like a finished store
+    tmp_path = os.path.join(store_path, CROPS_FILE + '.tmp')
+    dtype = first.dtype if encoding == 'float32' else ENCODINGS[encoding]
+    crops = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(len(names), *first.shape))
+    affine = np.empty((len(names), 2), dtype=np.float32)
+    for i, name in enumerate(names):
+        image = np.load(os.path.join(dataset_path, name))
+        if image.shape != first.shape:
+            raise ValueError(f"Crop '{name}' has shape {image.shape}, expected {first.shape}")
+        if encoding == 'float32':
+            crops[i] = image
+        else:
+            encoded, crop_affine = encode_crops(image[None], encoding)
+            crops[i] = encoded[0]
+            if crop_affine is not None:
+                affine[i] = crop_affine[0]
+    crops.flush()
+    del crops
+    if encoding == 'uint16':
+        np.save(os.path.join(store_path, AFFINE_FILE), affine)
+    os.replace(tmp_path, os.path.join(store_path, CROPS_FILE))
+
+    index = {'names': names,
+             'shape': [len(names), *first.shape],
+             'dtype': np.dtype(dtype).str,
+             'source': os.path.abspath(dataset_path),
+             'encoding': encoding}
+    with open(os.path.join(store_path, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+    return store_path
+
+
+class ShardedCrops:
+    '''
+    Several (n_i, H, W) shard memmaps indexed as one (sum n_i, H, W) array: ints, slices and index arrays
+    work like numpy indexing; a slice inside a single shard is a zero-copy view.
+    '''
+    def __init__(self, shards):
+        self.shards = shards
+        self.offsets = np.cumsum([0] + [len(shard) for shard in shards])
+        self.shape = (int(self.offsets[-1]), *shards[0].shape[1:])
+        self.dtype = shards[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def shard_of(self, indices):
+        return np.searchsorted(self.offsets, indices, side='right') - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            idx = idx + len(self) if idx < 0 else idx
+            shard = self.shard_of(idx)
+            return self.shards[shard][idx - self.offsets[shard]]
+
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            shard = self.shard_of(start)
+            if step == 1 and stop <= self.offsets[shard + 1]:
+                return self.shards[shard][start - self.offsets[shard]:stop - self.offsets[shard]]
+            idx = np.arange(start, stop, step)
+
+        idx = np.asarray(idx)
+        idx = np.where(idx < 0, idx + len(self), idx)
+        shards = self.shard_of(idx)
+        out = np.empty((len(idx), *self.shape[1:]), dtype=self.dtype)
+        for shard in np.unique(shards):
+            selected = shards == shard
+            out[selected] = self.shards[shard][idx[selected] - self.offsets[shard]]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return np.concatenate(self.shards).astype(dtype or self.dtype, copy=False)
+
+
+class EncodedCrops:
+    '''
+    A compact-encoded (N, H, W) crop memmap that indexes like the float32 array it encodes:
+    every read (int, slice or index array) is decoded to float32 in one vectorized pass.
+    '''
+    def __init__(self, crops, encoding, affine=None):
+        self.crops = crops
+        self.encoding = encoding
+        self.affine = affine
+        self.shape = crops.shape
+        self.dtype = np.dtype(np.float32)
+        self.ndim = crops.ndim
+
+    def __len__(self):
+        return len(self.crops)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, tuple)):
+            idx = np.asarray(idx)
+        affine = None if self.affine is None else self.affine[idx]
+        return decode_crops(self.crops[idx], self.encoding, affine)
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:].astype(dtype or self.dtype, copy=False)
+
+
+def open_crop_store(store_path, mmap_mode='c'):
+    # 'c' (copy-on-write) maps the file read-only on disk but gives writeable arrays,
+    # so torch.as_tensor/default_collate accept the slices without copying or warning
+    with open(os.path.join(store_path, INDEX_FILE)) as f:
+        index = json.load(f)
+    if 'shards' not in index:
+        crops = np.load(os.path.join(store_path, CROPS_FILE), mmap_mode=mmap_mode)
+        encoding = index.get('encoding', 'float32')
+        if encoding != 'float32':
+            affine = np.load(os.path.join(store_path, AFFINE_FILE)) if encoding == 'uint16' else None
+            crops = EncodedCrops(crops, encoding, affine)
+        return crops, index
+
+    shards = [np.load(os.path.join(store_path, shard['file']), mmap_mode=mmap_mode) for shard in index['shards']]
+    return (shards[0] if len(shards) == 1 else ShardedCrops(shards)), index
+
+
+def encode_crop_store(store_path, out_path, encoding, chunk_size=65536):
+    '''
+    Re-encodes any crop store (single file or sharded) into a single-file store with the given encoding,
+    keeping its names, positions and sources; e.g. a float16 copy of a float32 store at half the size.
+    '''
+    crops, index = open_crop_store(store_path, mmap_mode='r')
+    os.makedirs(out_path, exist_ok=True)
+    tmp_path = os.path.join(out_path, CROPS_FILE + '.tmp')
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=ENCODINGS[encoding], shape=crops.shape)
+    affine = np.empty((len(crops), 2), dtype=np.float32)
+    for start in range(0, len(crops), chunk_size):
+        encoded, chunk_affine = encode_crops(crops[start:start + chunk_size], encoding)
+        out[start:start + len(encoded)] = encoded
+        if chunk_affine is not None:
+            affine[start:start + len(encoded)] = chunk_affine
+    out.flush()
+    del out
+    if encoding == 'uint16':
+        np.save(os.path.join(out_path, AFFINE_FILE), affine)
+    for name in (POSITIONS_FILE, SKY_FILE):
+        if os.path.isfile(os.path.join(store_path, name)):
+            np.save(os.path.join(out_path, name), np.load(os.path.join(store_path, name)))
+    os.replace(tmp_path, os.path.join(out_path, CROPS_FILE))
+
+    index = {key: value for key, value in index.items() if key != 'shards'}
+    index.update(dtype=np.dtype(ENCODINGS[encoding]).str, encoding=encoding)
+    with open(os.path.join(out_path, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+    return out_path
+
+
+def block_mean(crops, factor):
+    # (N, H, W) crops -> (N, H/factor, W/factor) means of factor x factor pixel blocks, vectorized over the chunk
+    n, h, w = crops.shape
+    blocks = np.asarray(crops, dtype=np.float32).reshape(n, h // factor, factor, w // factor, factor)
+    return blocks.mean(axis=(2, 4), dtype=np.float32)
+
+
+def pyramid_path(store_path, factor):
+    return os.path.join(store_path, PYRAMID_DIR, f'{factor}x.npy')
+
+
+def load_crop_pyramid(store_path, factor, mmap_mode='r'):
+    # the store's (N, H/factor, W/factor) pyramid level, or None if it hasn't been built (or the store changed since)
+    path = pyramid_path(store_path, factor)
+    if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(os.path.join(store_path, INDEX_FILE)):
+        return None
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def build_crop_pyramid(store_path, factors=(2, 4), chunk_size=65536, overwrite=False):
+    '''
+    Writes downsampled copies of every crop of a store (block means over factor x factor pixels), one level per
+    factor, read in one pass over the store. Up-to-date levels are kept unless overwrite=True.
+    '''
+    crops, _ = open_crop_store(store_path, mmap_mode='r')
+    _, h, w = crops.shape
+    for factor in factors:
+        if h % factor or w % factor:
+            raise ValueError(f'Crops of shape {(h, w)} cannot be downsampled by {factor}')
+    factors = [factor for factor in factors if overwrite or load_crop_pyramid(store_path, factor) is None]
+    if not factors:
+        return
+    os.makedirs(os.path.join(store_path, PYRAMID_DIR), exist_ok=True)
+    levels = {factor: np.lib.format.open_memmap(pyramid_path(store_path, factor) + '.tmp', mode='w+',
+                                                dtype=np.float32, shape=(len(crops), h // factor, w // factor))
+              for factor in factors}
+    for start in range(0, len(crops), chunk_size):
+        chunk = np.asarray(crops[start:start + chunk_size], dtype=np.float32)
+        for factor, level in levels.items():
+            level[start:start + len(chunk)] = block_mean(chunk, factor)
+    for factor, level in levels.items():
+        level.flush()
+        del level
+        os.replace(pyramid_path(store_path, factor) + '.tmp', pyramid_path(store_path, factor))
+
+
+def map_year(source):
+    # 'yr3' for wmap_mollweide_imap_r9_yr3_K1_v5.fits, the file name for maps without a year
+    year = re.search(r'yr\d+', os.path.basename(source))
+    return year.group() if year else os.path.basename(source)
+
+
+def crop_keys(store_path, index):
+    # per-crop alignment keys: (year, row, col) for stores cut from sky maps, the crop name otherwise
+    positions_path = os.path.join(store_path, POSITIONS_FILE)
+    if not index.get('sources') or not os.path.isfile(positions_path):
+        return np.array(index['names'])
+    # years (not map indices) so that stores cut from different bands of the same years line up
+    years = [map_year(source) for source in index['sources']]
+    return np.array([f'{years[m]}_{y}_{x}' for m, y, x in np.load(positions_path).tolist()])
+
+
+def align_crop_stores(store_paths):
+    '''
+    (N, C) int64 array: row i holds the index of the same sky position in each of the C stores, for the N positions
+    present in all of them (in the first store's order). Cached in the first store, keyed by the stores' indexes.
+    '''
+    store_paths = [os.path.abspath(path) for path in store_paths]
+    stamp = [(path, os.stat(os.path.join(path, INDEX_FILE)).st_mtime) for path in store_paths]
+    key = hashlib.sha1(json.dumps(stamp).encode()).hexdigest()[:16]
+    cache_path = os.path.join(store_paths[0], f'aligned-{key}.npy')
+    if os.path.isfile(cache_path):
+        return np.load(cache_path)
+
+    keys = []
+    for path in store_paths:
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            store_keys = crop_keys(path, json.load(f))
+        if len(np.unique(store_keys)) != len(store_keys):
+            raise ValueError(f"Crop store '{path}' has several crops at the same position (more than one map per year?)")
+        keys.append(store_keys)
+
+    common = keys[0]
+    for store_keys in keys[1:]:
+        common = common[np.isin(common, store_keys)]
+    alignment = np.empty((len(common), len(keys)), dtype=np.int64)
+    for c, store_keys in enumerate(keys):
+        order = np.argsort(store_keys)
+        alignment[:, c] = order[np.searchsorted(store_keys, common, sorter=order)]
+
+    np.save(cache_path, alignment)
+    return alignment
+
+
+'''
+------------------------------------------------------------------------------------------------------------------------------------------
+Shared-memory crop tensors: one float32 copy of a crop set per machine, published under a named segment
+that DataLoader workers and concurrent training runs attach to instead of loading their own copy.
+
+segment layout: 64-byte int64 header [ready, ndim, *shape] followed by the float32 crops.
+'''
+SHARED_HEADER_BYTES = 64
+
+
+def crops_version(source):
+    # changes whenever the crop set is rebuilt: index.json of a crop store is only rewritten when its contents
+    # change, the manifest of a crop directory is rewritten whenever files are added or removed
+    if is_crop_store(source):
+        return str(os.stat(os.path.join(source, INDEX_FILE)).st_mtime_ns)
+    try:
+        with open(manifest_path(source), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except FileNotFoundError:
+        return str(os.stat(source).st_mtime_ns)
+
+
+def shared_crops_name(source, normalize=False, crop_filter=None):
+    # a rebuilt crop set gets a new name, so it is never served from a segment published before the rebuild
+    key = f'{os.path.abspath(source)}|version={crops_version(source)}|normalize={bool(normalize)}'
+    if crop_filter:
+        key += f'|filter={crop_filter}'
+    return 'wmap_' + hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def untrack(shm):
+    # python registers every segment it creates or attaches with the (per process tree) resource tracker, which
+    # unlinks it when the process exits - segments here are meant to outlive the process that published them
+    if os.name == 'posix':
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+
+def attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        untrack(shm)
+        return shm
+
+
+def unlink_shared_memory(shm):
+    # SharedMemory.unlink() also unregisters the segment from the resource tracker, which then complains (KeyError)
+    # about a segment untrack() already removed - register it again first (not needed for track=False segments)
+    if os.name == 'posix' and getattr(shm, '_track', True):
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+def shared_array(shm):
+    header = np.ndarray((SHARED_HEADER_BYTES // 8,), dtype=np.int64, buffer=shm.buf)
+    shape = tuple(int(n) for n in header[2:2 + header[1]])
+    return np.ndarray(shape, dtype=np.float32, buffer=shm.buf, offset=SHARED_HEADER_BYTES)
+
+
+def open_shared_crops(name, shape=None, fill=None, timeout=600):
+    '''
+    Returns (shm, array) for the crop tensor published under name. If shape/fill are given and nobody on this
+    machine has published it yet, this process allocates the segment, calls fill(array) once and publishes it;
+    everyone else waits until it is ready and attaches. The array is flagged non-writeable, but the memory is not
+    protected: a torch tensor over it (or a process ignoring the flag) writes straight into every attached copy.
+    Keep shm referenced for as long as the array is in use. The segment stays published after every process has
+    exited (so the next run attaches without touching the disk) until release_shared_crops(name) or a reboot.
+    '''
+    if shape is not None:
+        try:
+            size = SHARED_HEADER_BYTES + int(np.prod(shape)) * np.dtype(np.float32).itemsize
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            pass  # already published (or being published) by another process
+        else:
+            untrack(shm)
+            header = np.ndarray((SHARED_HEADER_BYTES // 8,), dtype=np.int64, buffer=shm.buf)
+            header[1] = len(shape)
+            header[2:2 + len(shape)] = shape
+            array = shared_array(shm)
+            try:
+                fill(array)
+            except BaseException:
+                del header, array
+                shm.close()
+                unlink_shared_memory(shm)
+                raise
+            header[0] = 1  # ready
+            array.flags.writeable = False
+            return shm, array
+
+    shm = attach_shared_memory(name)
+    header = np.ndarray((SHARED_HEADER_BYTES // 8,), dtype=np.int64, buffer=shm.buf)
+    deadline = time.time() + timeout
+    while header[0] != 1:
+        if time.time() > deadline:
+            raise TimeoutError(f"Shared crops '{name}' were never marked ready; if the publishing process died, "
+                               f"remove the segment with release_shared_crops('{name}')")
+        time.sleep(0.1)
+    array = shared_array(shm)
+    if shape is not None and array.shape != tuple(shape):
+        published = array.shape
+        del header, array
+        shm.close()
+        raise ValueError(f"Shared crops '{name}' have shape {published} but {tuple(shape)} "
+                         f"was expected; remove the stale segment with release_shared_crops('{name}')")
+    array.flags.writeable = False
+    return shm, array
+
+
+def release_shared_crops(name):
+    shm = attach_shared_memory(name)
+    shm.close()
+    unlink_shared_memory(shm)
@@ -1,35 +1,938 @@
 import os
-from torch.utils.data import Dataset
+import time
+import queue
+import warnings
+import threading
+import torch
+from torch.utils.data import Dataset, IterableDataset, Subset, Sampler, get_worker_info
+from torch.utils.data.dataloader import default_collate
 import numpy as np
+from crop_store import default_store_path, is_crop_store, build_crop_store, open_crop_store, list_crop_files
+from crop_store import shared_crops_name, open_shared_crops, align_crop_stores, ShardedCrops
+from crop_store import load_crop_pyramid, build_crop_pyramid
+from crop_stats import load_crop_stats, build_crop_stats, query_crop_stats
+from skymaps import SkyMap, SkyMapPool, tile_positions, holdout_blocks, load_mask, valid_pixels
+from projection import MollweideProjection, fill_outside_ellipse, gnomonic_offsets, gnomonic_sky, sky_centers
+from healpix import read_healpix_map, ud_grade, nside2order, block_order, pix2ang
 # from torchvision.io import read_image, ImageReadMode
 
 class WMAP(Dataset):
-    def __init__(self, dataset_path, transform=None, normalize=False):
+    def __init__(self, dataset_path, transform=None, normalize=False, storage='files', store_path=None, preload=False,
+                 shared=False, crop_filter=None):
+        '''
+        storage = 'files'  -> one np.load per crop (original behaviour)
+                  'memmap' -> crops are served as slices of a consolidated crop store (see crop_store.py),
+                              which is built next to the crop directory the first time it is needed.
+                              dataset_path may also point directly at a crop store.
+        preload = True -> (either storage) the whole crop set is read once into one contiguous float32 tensor
+                          (normalized once, if normalize=True); iterate it with TensorLoader instead of a DataLoader.
+        shared = True  -> like preload, but the tensor lives in a named shared-memory segment (one per crop set and
+                          normalize setting) that is published by the first process on the machine and attached
+                          by every other training run and DataLoader worker. Items and batches are copies; .tensor
+                          itself is the shared segment and is NOT write-protected (torch has no read-only tensors):
+                          in-place ops on it (e.g. .tensor.clamp_()) change the crops of every attached run.
+        crop_filter = query over the crop statistics catalog (see crop_stats.py, built on first use), e.g.
+                      'unique_values > 50 and std > 1e-3' -> the dataset only contains (and only ever reads)
+                      the matching crops of the store. Needs storage='memmap'.
+        '''
         self.dataset_path = dataset_path
         self.transform = transform
         self.normalize = normalize
-        # List all files in the image directory
-        self.img_list = [f for f in os.listdir(dataset_path) if os.path.isfile(os.path.join(dataset_path, f))]
+        self.preload = preload or shared
+        self.crops = None
+        self.tensor = None
+        self.shared_name = None
+        self.minmax = None
+        self.selection = None
+        self.batch_buffers = None
+        self.factor = 1
+
+        if is_crop_store(dataset_path):
+            storage, store_path = 'memmap', dataset_path
+        self.storage = storage
+
+        if storage == 'memmap':
+            store_path = store_path or default_store_path(dataset_path)
+            if not is_crop_store(store_path):
+                print(f"Building crop store at '{store_path}'...")
+                build_crop_store(dataset_path, store_path)
+            self.store_path = store_path
+            self.crops, index = open_crop_store(store_path)
+            self.img_list = index['names']
+            stats = load_crop_stats(store_path)
+            if stats is None and crop_filter is not None:
+                print(f"Building crop statistics catalog for '{store_path}'...")
+                stats = build_crop_stats(store_path)
+            if normalize and stats is not None:
+                # per-crop min/max precomputed by crop_stats.py, instead of a min/max pass over every crop every epoch
+                self.minmax = (np.array(stats['min']), np.array(stats['max']))
+            if crop_filter is not None:
+                # store indices of the matching crops; dataset index i is store crop selection[i]
+                self.selection = query_crop_stats(stats, crop_filter)
+                self.img_list = [self.img_list[i] for i in self.selection]
+                if self.minmax is not None:
+                    self.minmax = tuple(values[self.selection] for values in self.minmax)
+        elif storage == 'files':
+            # sorted crop list from the cached manifest (see crop_store.load_manifest) instead of os.listdir,
+            # so random_split sees the same order on every machine and every run
+            self.img_list = list_crop_files(dataset_path)
+        else:
+            raise ValueError(f"Unknown storage '{storage}', expected 'files' or 'memmap'")
+        if crop_filter is not None and storage != 'memmap':
+            raise ValueError("crop_filter needs a crop store, use storage='memmap'")
+
+        if self.preload and transform is not None:
+            raise ValueError("preload/shared modes do not support per-item transforms")
+        if shared:
+            self.shared_name = shared_crops_name(store_path if storage == 'memmap' else dataset_path, normalize,
+                                                 crop_filter)
+            shape = (len(self), *self.load(0).shape)
+            self._shm, array = open_shared_crops(self.shared_name, shape,
+                                                 fill=lambda out: self.load_all(out=torch.from_numpy(out)))
+            self.tensor = shared_tensor(array)
+        elif preload:
+            self.tensor = self.load_all()
+
+    def __getstate__(self):
+        # keep crop data out of the pickles sent to DataLoader workers: memmaps and shared segments are re-opened
+        state = self.__dict__.copy()
+        if self.crops is not None:
+            state['crops'] = None
+        if self.shared_name is not None:
+            state.update(tensor=None, _shm=None, img_list=None)
+        # worker batches are moved to shared memory anyway, a reused buffer would not save anything there
+        state['batch_buffers'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.storage == 'memmap' and self.crops is None:
+            self.crops = self.open_crops()
+        if self.shared_name is not None and self.tensor is None:
+            self._shm, array = open_shared_crops(self.shared_name)
+            self.tensor = shared_tensor(array)
+
+    def open_crops(self):
+        # the store's crops at the current resolution (pyramid levels are built on first use)
+        if self.factor == 1:
+            return open_crop_store(self.store_path)[0]
+        crops = load_crop_pyramid(self.store_path, self.factor)
+        if crops is None:
+            print(f"Building {self.factor}x pyramid level of '{self.store_path}'...")
+            build_crop_pyramid(self.store_path, factors=(self.factor,))
+            crops = load_crop_pyramid(self.store_path, self.factor)
+        return crops
+
+    def set_resolution(self, factor=1):
+        '''
+        factor > 1 -> crops are read from the store's factor x downsampled pyramid level (block means, see
+        crop_store.build_crop_pyramid) and repeated back up to the full crop size, so the models' input shape
+        doesn't change: coarse crops cost 1/factor^2 of the reads. With normalize and a stats catalog, a coarse
+        crop is exactly the block mean of the normalized full-resolution crop. factor = 1 -> full resolution.
+        Needs storage='memmap' and no preload.
+        '''
+        if factor == self.factor:
+            return self
+        if factor != 1 and (self.storage != 'memmap' or self.tensor is not None):
+            raise ValueError("Coarse resolutions need a crop store (storage='memmap') without preload")
+        self.factor = factor
+        self.crops = self.open_crops()
+        return self
+
+    def upsample(self, batch):
+        # coarse crops back to the full crop size (each coarse pixel repeated factor x factor times)
+        if self.factor == 1:
+            return batch
+        return batch.repeat_interleave(self.factor, dim=-2).repeat_interleave(self.factor, dim=-1)
+
+    def load_all(self, chunk_size=65536, out=None):
+        # reads the crop set in chunks straight into one preallocated float32 tensor
+        first = self.load(0)
+        tensor = torch.empty((len(self), *first.shape), dtype=torch.float32) if out is None else out
+        for start in range(0, len(self), chunk_size):
+            chunk = torch.from_numpy(np.asarray(self.get_batch(slice(start, start + chunk_size)), dtype=np.float32))
+            tensor[start:start + len(chunk)] = self.normalize_batch(chunk, slice(start, start + len(chunk))) \
+                if self.normalize else chunk
+        return tensor
 
     def __len__(self):
-        return len(self.img_list)
+        return len(self.tensor) if self.tensor is not None else len(self.img_list)
 
-    def __getitem__(self, idx):
+    def load(self, idx):
+        if self.crops is not None:
+            return self.crops[idx if self.selection is None else self.selection[idx]]  # zero-copy view into the memmap
         img_path = os.path.join(self.dataset_path, self.img_list[idx])
-        image = np.load(img_path)
+        return np.load(img_path)
+
+    def get_batch(self, indices, out=None):
+        # raw (un-normalized) crops for a batch: a slice gives a zero-copy view of the store,
+        # a list of indices gives one fancy-indexed read of the memmap.
+        # out: optional (B, H, W) array the crops are written into (and returned) instead of a new array
+        if self.crops is not None:
+            if self.selection is not None:
+                indices = self.selection[indices]
+            if isinstance(indices, slice):
+                batch = self.crops[indices]
+            elif out is not None and isinstance(self.crops, np.ndarray) and self.crops.dtype == out.dtype:
+                # gathered straight into out (mode='raise' would copy through a temporary, so bounds are checked here)
+                indices = np.asarray(indices)
+                if len(indices) and (indices.min() < -len(self.crops) or indices.max() >= len(self.crops)):
+                    raise IndexError(f'Crop index out of range for {len(self.crops)} crops')
+                return np.take(self.crops, indices, axis=0, out=out, mode='wrap')
+            else:
+                batch = self.crops[np.asarray(indices)]
+        else:
+            if isinstance(indices, slice):
+                indices = range(*indices.indices(len(self)))
+            if out is not None:
+                for i, idx in enumerate(indices):
+                    out[i] = self.load(idx)
+                return out
+            batch = np.stack([self.load(i) for i in indices])
+        if out is None:
+            return batch
+        out[...] = batch
+        return out
+
+    def use_batch_buffers(self, count=4):
+        '''
+        Batches from __getitems__ are written into a ring of `count` reused (B, 1, H, W) float32 tensors instead of
+        freshly allocated ones (single-process loading). A batch's memory is reused `count` batches later, so at most
+        count - 1 batches may be held at once (e.g. prefetch depth + the batch being trained on + the one being read).
+        '''
+        self.batch_buffers = BatchBuffers(count)
+        return self
+
+    def normalize_batch(self, batch, indices, inplace=False):
+        if self.minmax is None:
+            return normalize_batch(batch, inplace=inplace)
+        indices = indices if isinstance(indices, slice) else np.asarray(indices)
+        return normalize_batch(batch, *(torch.from_numpy(values[indices]) for values in self.minmax), inplace=inplace)
+
+    def __getitems__(self, indices):
+        # called by the DataLoader with a whole batch of indices (also through random_split Subsets);
+        # returns the (B, 1, H, W) float32 batch as a CollatedBatch, so use collate_batch as the loader's collate_fn
+        if self.tensor is not None:
+            batch = self.tensor[torch.as_tensor(indices)]
+        elif self.normalize and self.transform:
+            # arbitrary transforms only work per item
+            return CollatedBatch(default_collate([self[i] for i in indices]))
+        elif self.batch_buffers is not None:
+            batch = self.batch_buffers.get((len(indices), 1, *self.load(0).shape))
+            self.get_batch(indices, out=batch[:, 0].numpy())
+            if self.normalize:
+                self.normalize_batch(batch, indices, inplace=True)
+        else:
+            batch = torch.from_numpy(np.asarray(self.get_batch(indices), dtype=np.float32))
+            if self.normalize:
+                batch = self.normalize_batch(batch, indices)
+        batch = self.upsample(batch)
+        return CollatedBatch(batch.unsqueeze(1) if batch.dim() == 3 else batch)
+
+    def __getitem__(self, idx):
+        if self.tensor is not None:
+            image = self.tensor[idx].numpy()  # already normalized at preload time
+            return image.copy() if self.shared_name is not None else image
+
+        # float32 like the batches of __getitems__ (crop files are saved as float64)
+        image = np.asarray(self.load(idx), dtype=np.float32)
+        if self.factor != 1:
+            image = np.repeat(np.repeat(image, self.factor, axis=-2), self.factor, axis=-1)
 
         if self.normalize == False:
             return image
-    
-        if self.normalize == True:        
-            min_val = np.min(image.flatten())
-            max_val = np.max(image.flatten())
-            
+
+        if self.normalize == True:
+            if self.minmax is not None:
+                min_val, max_val = self.minmax[0][idx], self.minmax[1][idx]
+            else:
+                min_val = np.min(image.flatten())
+                max_val = np.max(image.flatten())
+
             if min_val != max_val:
-                normalized_image = (image - min_val) / (max_val - min_val)
+                normalized_image = ((image - min_val) / (max_val - min_val)).astype(np.float32, copy=False)
             else:
                 normalized_image = np.zeros_like(image)
             if self.transform:
                 normalized_image = self.transform(normalized_image)
-        
-            return normalized_image
\ No newline at end of file
+
+            return normalized_image
+
+
+class SkyMapCrops(IterableDataset):
+    '''
+    Streams crops cut on demand from the WMAP sky map FITS files instead of reading a pre-cut crop directory.
+    mode = 'random' -> crops_per_epoch crops at uniformly random positions, fresh every epoch
+                       (reproducible under torch.manual_seed, the same way DataLoader shuffling is)
+           'tiled'  -> every full (crop_size x crop_size) tile of every map, `stride` pixels apart (default: crop_size)
+    Each DataLoader worker opens the maps itself (memory-mapped) and gets its own share of the crops.
+    Indexing (dataset[i]) returns the i-th tile, e.g. for experiment's dataset[0] image size lookup.
+    mask: optional boolean (H, W) array (or .npy path) of valid pixels, e.g. the projection ellipse or a galactic cut;
+    mask_nan = True -> each map's NaN pixels are invalid too. Crops containing an invalid pixel are never cut: the
+                       valid positions of every map are indexed once up front and both modes only draw from them.
+    holdout: optional boolean (H, W) array (or .npy path) of held-out pixels no crop may overlap (see split()).
+    '''
+    def __init__(self, map_files, crop_size=28, mode='random', crops_per_epoch=100000, stride=None,
+                 normalize=False, hdu=1, chunk_size=256, mask=None, mask_nan=False, holdout=None):
+        if mode not in ('random', 'tiled'):
+            raise ValueError(f"Unknown mode '{mode}', expected 'random' or 'tiled'")
+        self.map_files = list(map_files)
+        self.crop_size = crop_size
+        self.mode = mode
+        self.crops_per_epoch = crops_per_epoch
+        self.stride = stride
+        self.normalize = normalize
+        self.hdu = hdu
+        self.chunk_size = chunk_size
+        self.mask = load_mask(mask)
+        self.mask_nan = mask_nan
+        self.holdout = load_mask(holdout)
+        self.maps = None
+
+        # only the map shapes (and masks) are read here; the maps themselves are opened lazily in whichever
+        # process iterates
+        shapes, valid = [], []
+        for path in self.map_files:
+            sky_map = SkyMap(path, hdu)
+            shapes.append(sky_map.shape)
+            valid_map = valid_pixels(sky_map, self.mask, mask_nan)
+            if self.holdout is not None:
+                valid_map = ~self.holdout if valid_map is None else valid_map & ~self.holdout
+            valid.append(valid_map)
+            sky_map.close()
+        self.shapes = np.array(shapes)
+
+        tiles = [tile_positions(shape, crop_size, stride, valid_map) for shape, valid_map in zip(shapes, valid)]
+        self.tiles = self.concatenate(tiles)
+
+        # random mode with a mask: every valid top-left corner (stride 1) of every map, sampled per map
+        self.valid = None
+        if mode == 'random' and any(valid_map is not None for valid_map in valid):
+            positions = [tile_positions(shape, crop_size, 1, valid_map) for shape, valid_map in zip(shapes, valid)]
+            counts = np.array([len(ys) for ys, _ in positions])
+            if np.any(counts == 0):
+                raise ValueError(f'No valid {crop_size}x{crop_size} crop in {self.map_files[np.argmin(counts)]}')
+            _, ys, xs = self.concatenate(positions)
+            self.valid = (np.cumsum(counts) - counts, counts, ys.astype(np.int32), xs.astype(np.int32))
+
+    @staticmethod
+    def concatenate(positions):
+        # per-map (ys, xs) -> (map_idx, ys, xs) over all maps
+        return (np.concatenate([np.full(len(ys), i) for i, (ys, _) in enumerate(positions)]),
+                np.concatenate([ys for ys, _ in positions]),
+                np.concatenate([xs for _, xs in positions]))
+
+    def tiled(self):
+        return SkyMapCrops(self.map_files, self.crop_size, mode='tiled', stride=self.stride,
+                           normalize=self.normalize, hdu=self.hdu, chunk_size=self.chunk_size,
+                           mask=self.mask, mask_nan=self.mask_nan, holdout=self.holdout)
+
+    def split(self, val_fraction=0.2, block_size=None, seed=0):
+        '''
+        (train, val) over a held-out region: a random val_fraction of the (block_size x block_size) blocks of the maps
+        (default: 4 crops wide, the same blocks in every map). The training crops never overlap the region; validation
+        is the tiling of the crops that lie entirely inside it.
+        '''
+        if len({tuple(shape) for shape in self.shapes}) > 1:
+            raise ValueError('A held-out region needs maps of the same shape')
+        holdout = holdout_blocks(self.shapes[0], block_size or 4 * self.crop_size, val_fraction, seed)
+        if self.holdout is not None:
+            holdout &= ~self.holdout
+        train = SkyMapCrops(self.map_files, self.crop_size, mode=self.mode, crops_per_epoch=self.crops_per_epoch,
+                            stride=self.stride, normalize=self.normalize, hdu=self.hdu, chunk_size=self.chunk_size,
+                            mask=self.mask, mask_nan=self.mask_nan,
+                            holdout=holdout if self.holdout is None else holdout | self.holdout)
+        val = SkyMapCrops(self.map_files, self.crop_size, mode='tiled', stride=self.stride,
+                          normalize=self.normalize, hdu=self.hdu, chunk_size=self.chunk_size,
+                          mask=holdout if self.mask is None else self.mask & holdout, mask_nan=self.mask_nan)
+        return train, val
+
+    def __len__(self):
+        return self.crops_per_epoch if self.mode == 'random' else len(self.tiles[0])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['maps'] = None  # open FITS files don't pickle, workers re-open them
+        return state
+
+    def open_maps(self):
+        if self.maps is None:
+            self.maps = [SkyMap(path, self.hdu) for path in self.map_files]
+        return self.maps
+
+    def cut(self, map_idx, ys, xs):
+        maps = self.open_maps()
+        crops = np.empty((len(map_idx), self.crop_size, self.crop_size), dtype=np.float32)
+        for i in np.unique(map_idx):
+            selected = map_idx == i
+            crops[selected] = maps[i].crops(ys[selected], xs[selected], self.crop_size)
+        if self.normalize:
+            crops = normalize_batch(torch.from_numpy(crops)).numpy()
+        return crops
+
+    def epoch_positions(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+
+        if self.mode == 'tiled':
+            return tuple(positions[worker_id::num_workers] for positions in self.tiles)
+
+        # the DataLoader draws a new worker seed from the torch RNG every epoch; without workers draw one here
+        seed = worker.seed if worker is not None else int(torch.empty((), dtype=torch.int64).random_())
+        rng = np.random.default_rng(seed)
+        n = self.crops_per_epoch // num_workers + (worker_id < self.crops_per_epoch % num_workers)
+        map_idx = rng.integers(len(self.map_files), size=n)
+        if self.valid is not None:
+            offsets, counts, valid_ys, valid_xs = self.valid
+            picks = offsets[map_idx] + rng.integers(0, counts[map_idx])
+            return map_idx, valid_ys[picks], valid_xs[picks]
+        ys = rng.integers(0, self.shapes[map_idx, 0] - self.crop_size + 1)
+        xs = rng.integers(0, self.shapes[map_idx, 1] - self.crop_size + 1)
+        return map_idx, ys, xs
+
+    def __iter__(self):
+        map_idx, ys, xs = self.epoch_positions()
+        for start in range(0, len(map_idx), self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            yield from self.cut(map_idx[chunk], ys[chunk], xs[chunk])
+
+    def __getitem__(self, idx):
+        map_idx, ys, xs = (positions[idx:idx + 1] for positions in self.tiles)
+        return self.cut(map_idx, ys, xs)[0]
+
+
+class StridedCrops(Dataset):
+    '''
+    Every (crop_size x crop_size) window of one or more in-memory sky maps, `stride` pixels apart, as a single
+    numpy sliding_window_view: overlapping crops cost no memory beyond the maps themselves, and a batch is one
+    fancy-indexed gather (the only copy). sky_maps are 2D arrays or FITS paths and must all have the same shape.
+    '''
+    def __init__(self, sky_maps, crop_size=28, stride=1, normalize=False, hdu=1):
+        if isinstance(sky_maps, (str, np.ndarray)):
+            sky_maps = [sky_maps]
+        maps = []
+        for sky_map in sky_maps:
+            if isinstance(sky_map, str):
+                fits_map = SkyMap(sky_map, hdu)
+                sky_map = fits_map.data
+                fits_map.close()
+            maps.append(np.nan_to_num(np.asarray(sky_map, dtype=np.float32)))
+
+        self.maps = np.stack(maps)
+        self.crop_size = crop_size
+        self.stride = stride
+        self.normalize = normalize
+        # (n_maps, n_rows, n_cols, crop_size, crop_size) view, no copy
+        self.windows = np.lib.stride_tricks.sliding_window_view(self.maps, (crop_size, crop_size), axis=(1, 2))[:, ::stride, ::stride]
+        self.grid = self.windows.shape[:3]
+
+    def __len__(self):
+        return int(np.prod(self.grid))
+
+    def position(self, indices):
+        # (map, row, col) of the top-left pixel of each crop
+        m, i, j = np.unravel_index(indices, self.grid)
+        return m, i * self.stride, j * self.stride
+
+    def get_batch(self, indices):
+        if isinstance(indices, slice):
+            indices = np.arange(*indices.indices(len(self)))
+        return self.windows[np.unravel_index(np.asarray(indices), self.grid)]
+
+    def __getitems__(self, indices):
+        batch = torch.from_numpy(self.get_batch(indices)).unsqueeze(1)
+        return CollatedBatch(normalize_batch(batch) if self.normalize else batch)
+
+    def __getitem__(self, idx):
+        if self.normalize:
+            return self.__getitems__([idx]).tensor[0, 0].numpy()
+        return self.windows[np.unravel_index(idx, self.grid)]
+
+
+class MultiYearCrops(Dataset):
+    '''
+    The same sky position across several years of maps (e.g. the yr1..yr9 maps of one band), cut on demand from
+    the FITS files, without writing a crop directory per year.
+    layout = 'channels' -> items are (Y, H, W), batches (B, Y, H, W): years as image channels
+             'sequence' -> items are (Y, 1, H, W), batches (B, Y, 1, H, W): years as a sequence of images
+    map_files: one map per year, in channel/sequence order; all maps must have the same shape.
+    mask: optional boolean (H, W) array (or .npy path) of valid pixels; positions whose tile contains an invalid
+          pixel in any year are dropped. mask_nan = True -> every year's NaN pixels are invalid too.
+    max_open: the yearly maps are memory-mapped lazily (from the map cache) and stay mapped, so a batch reading every
+              year never reopens a map; max_open only caps FITS handles of uncached maps (see SkyMapPool).
+    '''
+    def __init__(self, map_files, crop_size=28, stride=None, layout='channels', mask=None, normalize=False, hdu=1,
+                 max_open=None, mask_nan=False):
+        if layout not in ('channels', 'sequence'):
+            raise ValueError(f"Unknown layout '{layout}', expected 'channels' or 'sequence'")
+        self.map_files = list(map_files)
+        self.crop_size = crop_size
+        self.layout = layout
+        self.normalize = normalize
+        self.channels = len(self.map_files) if layout == 'channels' else 1
+        self.maps = SkyMapPool(self.map_files, hdu, max_open)
+
+        shapes = set()
+        valid = load_mask(mask)
+        for i in range(len(self.maps)):
+            shapes.add(self.maps[i].shape)
+            if len(shapes) > 1:
+                raise ValueError(f'Yearly maps have different shapes: {sorted(shapes)}')
+            valid = valid_pixels(self.maps[i], valid, mask_nan)
+        self.ys, self.xs = tile_positions(shapes.pop(), crop_size, stride, valid)
+
+    def __len__(self):
+        return len(self.ys)
+
+    def position(self, indices):
+        return self.ys[indices], self.xs[indices]
+
+    def get_batch(self, indices):
+        # raw (B, Y, H, W) crops: one fancy-indexed read per yearly map
+        ys, xs = self.position(indices)
+        out = np.empty((len(ys), len(self.maps), self.crop_size, self.crop_size), dtype=np.float32)
+        for year in range(len(self.maps)):
+            out[:, year] = self.maps[year].crops(ys, xs, self.crop_size)
+        return out
+
+    def __getitems__(self, indices):
+        # use collate_batch as the loader's collate_fn
+        batch = torch.from_numpy(self.get_batch(np.asarray(indices)))
+        if self.normalize:
+            batch = normalize_batch(batch.flatten(0, 1)).view_as(batch)
+        return CollatedBatch(batch.unsqueeze(2) if self.layout == 'sequence' else batch)
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx]).tensor[0].numpy()
+
+
+class GnomonicPatches(Dataset):
+    '''
+    Locally flat (gnomonic) patches centred on arbitrary sky positions, resampled from the Mollweide maps instead of
+    cut as squares of the Mollweide image (whose shapes are increasingly sheared towards the map edges).
+    A batch of patches is a single bilinear grid_sample over the map tensor (per map in the batch).
+
+    sky_maps: FITS paths (or 2D arrays) of Mollweide maps of the same shape; items are (map, centre) pairs, map-major.
+    centers: (l, b) arrays of patch centres in galactic degrees; None -> a near-uniform set of positions
+             `spacing` degrees apart (default: one patch width), without the band |b| < min_abs_b.
+    resolution: degrees per patch pixel (default: the maps' pixel size at the centre of the projection, 360 / W).
+    device: where the maps are kept and sampled (e.g. 'cuda'); batches are returned on that device.
+    '''
+    def __init__(self, sky_maps, centers=None, patch_size=28, resolution=None, spacing=None, min_abs_b=0,
+                 normalize=False, hdu=1, device=None):
+        if isinstance(sky_maps, (str, np.ndarray)):
+            sky_maps = [sky_maps]
+        maps, projection = [], None
+        for sky_map in sky_maps:
+            if isinstance(sky_map, str):
+                fits_map = SkyMap(sky_map, hdu)
+                projection = projection or fits_map.projection()
+                sky_map = fits_map.data
+                fits_map.close()
+            maps.append(np.nan_to_num(np.asarray(sky_map, dtype=np.float32)))
+        if len({m.shape for m in maps}) > 1:
+            raise ValueError(f'Maps have different shapes: {sorted({m.shape for m in maps})}')
+
+        self.projection = projection or MollweideProjection(maps[0].shape)
+        maps = [fill_outside_ellipse(m, self.projection.valid) for m in maps]
+        self.maps = torch.from_numpy(np.stack(maps)).unsqueeze(1).to(device)  # (M, 1, H, W)
+        self.patch_size = patch_size
+        self.resolution = resolution or 360 / maps[0].shape[1]
+        self.normalize = normalize
+        self.xi, self.eta = gnomonic_offsets(patch_size, self.resolution,
+                                             self.projection.x_sign, self.projection.y_sign)
+        if centers is None:
+            centers = sky_centers(spacing or patch_size * self.resolution, min_abs_b)
+        self.l, self.b = (np.asarray(values, dtype=np.float64) for values in centers)
+
+    def __len__(self):
+        return len(self.maps) * len(self.l)
+
+    def position(self, indices):
+        # (map, l, b) of each patch
+        map_idx, center = np.divmod(np.asarray(indices), len(self.l))
+        return map_idx, self.l[center], self.b[center]
+
+    def sampling_grid(self, l, b):
+        # (B, S, S, 2) grid_sample coordinates (x, y in [-1, 1], align_corners=True) of patches centred on (l, b)
+        rows, cols = self.projection.sky_to_pixel(*gnomonic_sky(l, b, self.xi, self.eta))
+        H, W = self.projection.shape
+        grid = np.stack([cols / (W - 1) * 2 - 1, rows / (H - 1) * 2 - 1], axis=-1)
+        return torch.from_numpy(grid.astype(np.float32)).to(self.maps.device)
+
+    def extract(self, l, b, map_idx=0):
+        '''(B, 1, S, S) raw patches of map(s) map_idx centred on galactic (l, b) in degrees.'''
+        l, b = np.atleast_1d(l), np.atleast_1d(b)
+        map_idx = np.broadcast_to(map_idx, l.shape)
+        grid = self.sampling_grid(l, b)
+        S = self.patch_size
+        out = torch.empty((len(l), 1, S, S), dtype=torch.float32, device=self.maps.device)
+        for m in np.unique(map_idx):
+            selected = torch.from_numpy(np.flatnonzero(map_idx == m)).to(self.maps.device)
+            # all patches of the map as one tall (1, B*S, S) grid over the single map image
+            patches = torch.nn.functional.grid_sample(self.maps[m:m + 1], grid[selected].view(1, -1, S, 2),
+                                                      mode='bilinear', padding_mode='border', align_corners=True)
+            out[selected] = patches.view(-1, 1, S, S)
+        return out
+
+    def __getitems__(self, indices):
+        # use collate_batch as the loader's collate_fn
+        map_idx, l, b = self.position(indices)
+        batch = self.extract(l, b, map_idx)
+        return CollatedBatch(normalize_batch(batch) if self.normalize else batch)
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx]).tensor[0, 0].cpu().numpy()
+
+
+class HealpixPatches(Dataset):
+    '''
+    Square patches of native HEALPix maps (NESTED ordering, e.g. the WMAP wmap_band_imap_* files): every aligned
+    patch_size x patch_size block of a base face is a contiguous run of the nested pixel array, so patches are
+    reshaped out of the map (reordered once, when the maps are loaded) rather than projected or interpolated.
+    Patches are laid out on the face's (x, y) grid: rows run along x (towards the north-east), columns along y.
+
+    map_files: HEALPix FITS maps of the same nside; items are (map, patch) pairs, map-major.
+    patch_size: power of 2, at most nside. crop_size: optional centre crop of every patch (e.g. 32 -> 28 for the
+                28 x 28 models). nside: optional resolution the maps are ud_graded to first.
+    mask_bad = True -> patches containing unobserved (NaN / UNSEEN) pixels are left out; otherwise they are zeros.
+    min_abs_b: leave out patches whose centre is in the galactic band |b| < min_abs_b (degrees).
+    '''
+    def __init__(self, map_files, patch_size=32, crop_size=None, nside=None, field=0, hdu=1, normalize=False,
+                 mask_bad=False, min_abs_b=0):
+        if isinstance(map_files, str):
+            map_files = [map_files]
+        maps, nsides = [], set()
+        for path in map_files:
+            values, map_nside = read_healpix_map(path, field, hdu)
+            if nside is not None and nside != map_nside:
+                values, map_nside = ud_grade(values, nside), nside
+            maps.append(values)
+            nsides.add(map_nside)
+        if len(nsides) > 1:
+            raise ValueError(f'Maps have different nsides: {sorted(nsides)}, pass nside to ud_grade them')
+        self.nside = nsides.pop()
+        nside2order(patch_size)
+        if patch_size > self.nside:
+            raise ValueError(f'patch_size {patch_size} is larger than a base face ({self.nside} pixels)')
+
+        self.patch_size = patch_size
+        self.crop_size = crop_size or patch_size
+        self.normalize = normalize
+        # (M, n_patches, S, S): consecutive runs of S^2 nested pixels, reordered onto the patch grid
+        n_patches = len(maps[0]) // patch_size ** 2
+        patches = np.stack(maps).reshape(len(maps), n_patches, patch_size ** 2)[:, :, block_order(patch_size).ravel()]
+        patches = patches.reshape(len(maps), n_patches, patch_size, patch_size)
+
+        keep = np.ones(patches.shape[:2], dtype=bool)
+        if mask_bad:
+            keep &= ~np.isnan(patches).any(axis=(2, 3))
+        if min_abs_b:
+            theta, _ = pix2ang(self.nside, self.center_pixels(np.arange(n_patches)))
+            keep &= np.abs(90 - np.degrees(theta)) >= min_abs_b
+        self.patches = np.nan_to_num(patches)
+        self.items = np.flatnonzero(keep.ravel())
+
+    def __len__(self):
+        return len(self.items)
+
+    def center_pixels(self, patch_idx):
+        # NESTED pixel at the middle of each patch
+        half = self.patch_size // 2
+        return np.asarray(patch_idx) * self.patch_size ** 2 + block_order(self.patch_size)[half, half]
+
+    def position(self, indices):
+        # (map, theta, phi) of the centre of each patch, radians
+        map_idx, patch_idx = np.divmod(self.items[indices], self.patches.shape[1])
+        return (map_idx, *pix2ang(self.nside, self.center_pixels(patch_idx)))
+
+    def get_batch(self, indices):
+        # raw (B, C, C) patches (C = crop_size)
+        map_idx, patch_idx = np.divmod(self.items[indices], self.patches.shape[1])
+        start = (self.patch_size - self.crop_size) // 2
+        crop = slice(start, start + self.crop_size)
+        return self.patches[map_idx, patch_idx, crop, crop]
+
+    def __getitems__(self, indices):
+        # use collate_batch as the loader's collate_fn
+        batch = torch.from_numpy(self.get_batch(np.asarray(indices))).unsqueeze(1)
+        return CollatedBatch(normalize_batch(batch) if self.normalize else batch)
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx]).tensor[0, 0].numpy()
+
+
+class MultiBandWMAP(Dataset):
+    '''
+    Spatially aligned crops of several bands / differencing assemblies (e.g. K1, Ka1, Q1, V1, W1) stacked as
+    channels: items are (C, H, W) arrays, batches (B, C, H, W) tensors - build the model with image_channels=C.
+
+    band_paths: one crop store (or crop directory, whose store is built on first use) per band, in channel order.
+    Crops are matched by sky position (year + pixel, for stores cut by crop_builder.py) or else by crop name;
+    only positions present in every band are kept. The alignment is computed once and cached in the first store.
+    normalize = True -> per-crop, per-channel min/max rescaling, like WMAP(normalize=True) on each band.
+    '''
+    def __init__(self, band_paths, normalize=False):
+        self.bands = [WMAP(path, storage='memmap') for path in band_paths]
+        self.normalize = normalize
+        self.channels = len(self.bands)
+        self.crop_shape = self.bands[0].load(0).shape
+        for band in self.bands[1:]:
+            if band.load(0).shape != self.crop_shape:
+                raise ValueError(f"Band '{band.dataset_path}' has crops of shape {band.load(0).shape}, "
+                                 f"expected {self.crop_shape}")
+        self.alignment = align_crop_stores([band.store_path for band in self.bands])
+        # stores cut with the same parameters line up one to one: batches are then plain slices of every band
+        self.identity = all(len(band) == len(self.alignment) for band in self.bands) and \
+            bool(np.all(self.alignment == np.arange(len(self.alignment))[:, None]))
+
+    def __len__(self):
+        return len(self.alignment)
+
+    def get_batch(self, indices):
+        # raw (B, C, H, W) crops; each band's memmap is read once per batch, in increasing file order
+        if self.identity and isinstance(indices, slice):
+            return np.stack([band.crops[indices] for band in self.bands], axis=1)
+        rows = self.alignment[np.arange(len(self))[indices] if isinstance(indices, slice) else np.asarray(indices)]
+        out = np.empty((len(rows), self.channels, *self.crop_shape), dtype=np.float32)
+        for c, band in enumerate(self.bands):
+            order = np.argsort(rows[:, c], kind='stable')
+            out[order, c] = band.crops[rows[order, c]]
+        return out
+
+    def __getitems__(self, indices):
+        # (B, C, H, W) float32 CollatedBatch, use collate_batch as the loader's collate_fn
+        batch = torch.from_numpy(np.asarray(self.get_batch(indices), dtype=np.float32))
+        if self.normalize:
+            batch = normalize_batch(batch.flatten(0, 1)).view_as(batch)
+        return CollatedBatch(batch)
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx]).tensor[0].numpy()
+
+
+def shared_tensor(array):
+    # torch has no read-only tensors and warns when wrapping the (non-writeable) shared array: the tensor is still
+    # writable, so every read from it hands out a copy (see WMAP.__getitem__ and TensorLoader)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        return torch.from_numpy(array)
+
+
+def normalize_batch(batch, min_val=None, max_val=None, inplace=False):
+    # same per-crop min/max rescaling as WMAP.__getitem__, vectorized over the whole batch;
+    # min_val/max_val: precomputed (B,) per-crop minima/maxima (see crop_stats.py)
+    if min_val is None:
+        min_val, max_val = torch.aminmax(batch.flatten(1), dim=1)
+    shape = (-1,) + (1,) * (batch.dim() - 1)
+    min_val, span = min_val.view(shape), (max_val - min_val).view(shape)
+    nonconstant = span > 0
+    # constant crops (min == max) become all zeros
+    if inplace:
+        return batch.sub_(min_val).div_(torch.where(nonconstant, span, torch.ones_like(span))).mul_(nonconstant)
+    return (batch - min_val) / torch.where(nonconstant, span, torch.ones_like(span)) * nonconstant
+
+
+class CollatedBatch(list):
+    '''
+    What the datasets' __getitems__ return: the per-item views of an already built batch tensor, so a DataLoader
+    with the default collate_fn still works (stacking them into a copy), plus the batch tensor itself (.tensor),
+    which collate_batch returns without copying.
+    '''
+    def __init__(self, tensor):
+        super().__init__(tensor.unbind(0))
+        self.tensor = tensor
+
+
+def collate_batch(batch):
+    # __getitems__ already returns a collated batch
+    if isinstance(batch, CollatedBatch):
+        return batch.tensor
+    if isinstance(batch, torch.Tensor):
+        return batch
+    return default_collate(batch)
+
+
+def unwrap_subsets(dataset):
+    # (base dataset, index tensor over it) for (possibly nested) Subsets; indices is None for the base dataset itself
+    base, indices = dataset, None
+    while isinstance(base, Subset):
+        subset_indices = torch.as_tensor(base.indices)
+        indices = subset_indices if indices is None else subset_indices[indices]
+        base = base.dataset
+    return base, indices
+
+
+class ShardShuffleSampler(Sampler):
+    '''
+    Locality-aware replacement for DataLoader(shuffle=True) over a crop store (WMAP, or a random_split Subset of one).
+    Every epoch the store's shards (one per map for stores cut by crop_builder.py, blocks of block_size consecutive
+    crops otherwise) are visited in a random order, each one front to back, and the crops are shuffled within a
+    sliding window of buffer_size crops. Reads stay (nearly) sequential, so readahead and the page cache work,
+    while batches still mix crops from across the window and, at shard boundaries, from neighbouring shards.
+    '''
+    def __init__(self, dataset, buffer_size=16384, block_size=65536, generator=None):
+        self.dataset = dataset
+        self.buffer_size = buffer_size
+        self.generator = generator
+
+        base, indices = unwrap_subsets(dataset)
+        store_indices = np.arange(len(base)) if indices is None else indices.numpy()
+        crops = getattr(base, 'crops', None)
+        if getattr(base, 'selection', None) is not None:
+            store_indices = base.selection[store_indices]
+        if isinstance(crops, ShardedCrops):
+            shards = crops.shard_of(store_indices)
+        else:
+            shards = store_indices // block_size
+        # dataset positions grouped by shard, in store order within each shard
+        order = np.lexsort((store_indices, shards))
+        self.shards = np.split(order, np.flatnonzero(np.diff(shards[order])) + 1)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        # like RandomSampler: without a generator, a new seed is drawn from the torch RNG every epoch
+        seed = int(torch.empty((), dtype=torch.int64).random_(generator=self.generator).item())
+        rng = np.random.default_rng(seed)
+        sequence = np.concatenate([self.shards[i] for i in rng.permutation(len(self.shards))])
+        # each crop moves up to buffer_size places from its position in the read sequence
+        keys = np.arange(len(sequence)) + rng.uniform(0, self.buffer_size, size=len(sequence))
+        yield from sequence[np.argsort(keys)].tolist()
+
+
+class BatchBuffers:
+    # ring of preallocated float32 batch tensors, handed out in turn (see WMAP.use_batch_buffers)
+    def __init__(self, count=4):
+        self.buffers = [None] * count
+        self.next = 0
+        self.allocations = 0
+
+    def get(self, shape):
+        buffer = self.buffers[self.next]
+        if buffer is None or buffer.shape[1:] != shape[1:] or len(buffer) < shape[0]:
+            buffer = torch.empty(shape, dtype=torch.float32)
+            self.buffers[self.next] = buffer
+            self.allocations += 1
+        self.next = (self.next + 1) % len(self.buffers)
+        return buffer[:shape[0]]
+
+
+class TensorLoader:
+    '''
+    Stand-in for a DataLoader over a preloaded WMAP (or a random_split Subset of one). Every batch is a single
+    index-gather from the preloaded tensor: no per-item __getitem__ calls, no workers and no default_collate.
+    Exposes .dataset and len() like a DataLoader, so experiment.train/evaluate use it unchanged.
+    '''
+    def __init__(self, dataset, batch_size, shuffle=False, drop_last=False, generator=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+        base, indices = unwrap_subsets(dataset)
+        if getattr(base, 'tensor', None) is None:
+            raise ValueError("TensorLoader needs a WMAP dataset created with preload=True")
+        self.data = base.tensor
+        self.indices = indices
+        # batches of a shared crop tensor are copied, so in-place ops on them can't reach the other attached runs
+        self.shared = getattr(base, 'shared_name', None) is not None
+
+    def __len__(self):
+        n = len(self.dataset)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    def __iter__(self):
+        n = len(self.dataset)
+        if self.shuffle:
+            order = torch.randperm(n, generator=self.generator)
+            order = order if self.indices is None else self.indices[order]
+        else:
+            order = self.indices  # None -> contiguous slices of the tensor (no copy)
+
+        stop = n - n % self.batch_size if self.drop_last else n
+        for start in range(0, stop, self.batch_size):
+            if order is None:
+                batch = self.data[start:start + self.batch_size]
+                batch = batch.clone() if self.shared else batch
+            else:
+                batch = self.data[order[start:start + self.batch_size]]
+            yield batch.unsqueeze(1) if batch.dim() == 3 else batch
+
+
+class PrefetchLoader:
+    '''
+    Wraps a DataLoader (or TensorLoader / AugmentedLoader): a background thread iterates it and keeps up to `depth`
+    batches ready - collated, contiguous float32 and, when training on a GPU, in pinned memory so the copy to the
+    device can be non_blocking - while the training step runs. With num_workers=0 this overlaps the crop reads
+    (np.load / memmap gathers) of batch N+1 with the step on batch N.
+    Exposes .dataset and len() like a DataLoader. Per pass over it, counts how often (stalls) and how long
+    (stall_time, seconds) the training loop waited for a batch that wasn't ready; see stall_summary().
+    '''
+    def __init__(self, loader, depth=2, pin_memory=None):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.depth = depth
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.batches = self.stalls = 0
+        self.stall_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def prepare(self, batch):
+        batch = batch.to(torch.float32).contiguous()
+        return batch.pin_memory() if self.pin_memory else batch
+
+    def produce(self, ready, stop):
+        def put(item):
+            # gives up when the consumer has stopped iterating, instead of blocking on a full queue forever
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in self.loader:
+                if not put(('batch', self.prepare(batch))):
+                    return
+            put(('done', None))
+        except BaseException as e:
+            put(('error', e))
+
+    def __iter__(self):
+        self.batches = self.stalls = 0
+        self.stall_time = 0.0
+        ready, stop = queue.Queue(maxsize=self.depth), threading.Event()
+        thread = threading.Thread(target=self.produce, args=(ready, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    kind, item = ready.get_nowait()
+                    waited = False
+                except queue.Empty:
+                    kind, item = ready.get()
+                    waited = True
+                if kind == 'done':
+                    return
+                if kind == 'error':
+                    raise item
+                if waited:
+                    self.stalls += 1
+                    self.stall_time += time.perf_counter() - start
+                self.batches += 1
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def stall_summary(self):
+        return (f'{self.stalls}/{self.batches} batches waited on data '
+                f'({self.stall_time:.2f}s total, {1000 * self.stall_time / max(self.batches, 1):.1f}ms per batch)')
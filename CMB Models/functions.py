@@ -6,6 +6,7 @@ import astropy.visualization as vis
 import matplotlib.pyplot as plt
 import time
 from IPython.display import clear_output
+from skymaps import cached_map
 
 
 def FitsMapper(files, hdul_index, nrows, ncols, cmap, interpolation, histogram=False, bins=100,
@@ -24,8 +25,8 @@ def FitsMapper(files, hdul_index, nrows, ncols, cmap, interpolation, histogram=F
         axs = axs.flatten()
 
     for i, file in enumerate(files):
-        with fits.open(file) as hdul:
-            data = hdul[hdul_index].data
+        # float32 image with NaNs zeroed, memory-mapped from the map cache (converted once per map, see skymaps.py)
+        data, _ = cached_map(file, hdul_index)
         
         # creating dictionaries for available intervals and stretches in astropy.visualization (vis in this notebook)
         intervals = {'ZScale': vis.ZScaleInterval(),
@@ -43,8 +44,7 @@ def FitsMapper(files, hdul_index, nrows, ncols, cmap, interpolation, histogram=F
                     'Sinh': vis.SinhStretch(),
                     'Contrast': vis.ContrastBiasStretch(contrast=contrast, bias=bias)}
 
-        # converting data to float type and normalizing
-        data = np.nan_to_num(data.astype(float))
+        # normalizing
         vis_vmin, vis_vmax = np.percentile(data, [vmin, vmax])
         norm = vis.ImageNormalize(data, vmin=vis_vmin, vmax=vis_vmax, interval=intervals[interval], stretch=stretches[stretch])
 
@@ -101,7 +101,10 @@ class experiment:
         # self.teloader = teloader
         self.batch_size = batch_size
         
-        self.x_dim = self.trloader.dataset[0].shape[0]*self.trloader.dataset[0].shape[1]
+        # items are (H, W) crops, or (C, H, W) for multi-channel datasets (e.g. datasets.MultiBandWMAP)
+        item_shape = tuple(self.trloader.dataset[0].shape)
+        self.image_shape = item_shape if len(item_shape) == 3 else (1, *item_shape)
+        self.x_dim = self.image_shape[1]*self.image_shape[2]
         self.train_size = len(self.trloader.dataset) # number of datapoints in the training set
         self.num_batches = self.train_size / self.batch_size # number of batches in the training set
 
@@ -170,7 +173,7 @@ class experiment:
         return total_loss, reconstruction_loss, kl_weight, KL_loss
 
     def train(self, optimizer, epochs, kl_weight, save_every_n_epochs=10,
-              averaging=True, resume_from_epoch=None, resume_timestamp=None, anneal=False):  
+              averaging=True, resume_from_epoch=None, resume_timestamp=None, anneal=False, resolution_schedule=None):  
         
         # ========================== Logger & Tensorboard Configuration ==========================
         torch.backends.cudnn.benchmark = True
@@ -241,6 +244,18 @@ class experiment:
                     # f'\nDecoder Parameters: {params[2]}\n')
         logger.info(f'Train Loader Image Data Size: {self.trloader.dataset[0].shape}')
         
+        if resolution_schedule:
+            # coarse-to-fine training, e.g. {1: 4, 2001: 2, 5001: 1}: the training crops of every epoch are read at the
+            # downsampling factor scheduled from the latest first epoch <= epoch (datasets.WMAP.set_resolution);
+            # validation always runs at full resolution so its loss stays comparable
+            train_dataset = self.trloader.dataset
+            while hasattr(train_dataset, 'dataset'):  # Subsets
+                train_dataset = train_dataset.dataset
+            if not hasattr(train_dataset, 'set_resolution'):
+                raise ValueError('resolution_schedule needs a dataset with set_resolution (datasets.WMAP)')
+            logger.info(f'Resolution schedule (first epoch: downsampling factor): {resolution_schedule}')
+            scheduled_factor = None
+
         start_time = time.time()
         try:
             foldername=f'./Checkpoints/{self.timestamp}'
@@ -249,6 +264,15 @@ class experiment:
             for epoch in range(start_epoch, epochs + 1):
                 self.epoch = epoch
 
+                if resolution_schedule:
+                    starts = [start for start in resolution_schedule if start <= epoch]
+                    factor = resolution_schedule[max(starts)] if starts else 1
+                    if factor != scheduled_factor:
+                        logger.info(f'Epoch {epoch}: training on {factor}x downsampled crops.')
+                        scheduled_factor = factor
+                    train_dataset.set_resolution(factor)
+                    writer_train.add_scalar('resolution factor', factor, (epoch-1) * self.num_batches)
+
                 # ========================= training losses =========================
                 self.model.train()
                 randint = random.randint(0, self.num_batches-1) # -1 to avoid index out of range
@@ -256,8 +280,8 @@ class experiment:
                     self.global_index = (epoch-1) * self.num_batches + i
                     batch_start = time.time()
 
-                    batch = batch.view(batch.size(0), 1, 28, 28)
-                    batch = batch.to(self.device)
+                    batch = batch.view(batch.size(0), *self.image_shape)
+                    batch = batch.to(self.device, non_blocking=True)  # asynchronous for pinned (prefetched) batches
 
                     optimizer.zero_grad()
 
@@ -288,15 +312,21 @@ class experiment:
                     batch_loss.backward()
                     optimizer.step()
 
+                if hasattr(self.trloader, 'stall_summary'):
+                    # datasets.PrefetchLoader: how long the training loop waited on data this epoch
+                    logger.info(f'Data loading (epoch {self.epoch}): {self.trloader.stall_summary()}')
+                    writer_train.add_scalar('data stall time', self.trloader.stall_time, self.global_index)
                 
                 # ========================= validation losses =========================
+                if resolution_schedule:
+                    train_dataset.set_resolution(1)
                 logger.info(f'Calculating validation for epoch {self.epoch}.')
                 self.model.eval()
                 with torch.no_grad():
                     tot_valoss = 0
                     for batch in self.valoader:
 
-                        batch = batch.view(batch.size(0), 1, 28, 28)
+                        batch = batch.view(batch.size(0), *self.image_shape)
                         batch = batch.to(self.device)
                         
                         outputs, mean, log_var = self.model(batch)
@@ -395,7 +425,7 @@ class experiment:
         with torch.no_grad():
             for images in self.valoader:
                 images = images.to(self.device)
-                images = images.view(images.size(0), 1, 28, 28)
+                images = images.view(images.size(0), *self.image_shape)
 
                 reconstruction_images, _, _ = self.model(images)
                 reconstruction_images = reconstruction_images.view_as(images)
@@ -417,7 +447,7 @@ class experiment:
 
             images = next(data_iter)
             images = images[:num_images].to(self.device)
-            images = images.view(images.size(0), 1, 28, 28)
+            images = images.view(images.size(0), *self.image_shape)
 
             reconstruction_images, _, _ = self.model(images)
             reconstruction_images = reconstruction_images.cpu()
@@ -552,7 +582,7 @@ class experiment:
         latent_vectors = []
         with torch.no_grad():
             for batches in self.valoader:
-                batches = batches.view(batches.size(0), 1, 28, 28).to(self.device)
+                batches = batches.view(batches.size(0), *self.image_shape).to(self.device)
                 
                 h = self.model.encoder(batches)
                 z, mu, logvar = self.model.bottleneck(h)
@@ -572,7 +602,7 @@ class experiment:
 
         n = number of images to plot
         '''
-        w = self.valoader.dataset[0].shape[0]  # image width
+        w = self.image_shape[-1]  # image width
         img = np.zeros((n*w, n*w))
         for i, y in enumerate(np.linspace(*rangey, n)):
             for j, x in enumerate(np.linspace(*rangex, n)):
@@ -6,7 +6,7 @@ import torch
 # data processing
 from torch.utils.data import DataLoader
 import torchvision.transforms as transforms
-from torch.utils.data import random_split
+from torch.utils.data import IterableDataset
 
 # plotting & visualization
 import seaborn as sns
@@ -15,26 +15,68 @@ import matplotlib.pyplot as plt
 from model import ConvVAE
 sys.path.append('../')
 from functions import experiment
+from datasets import collate_batch, TensorLoader, ShardShuffleSampler, PrefetchLoader
+from augment import DihedralAugment, AugmentedLoader
+from splits import split_dataset
 
 ''' ASSUMPTION - the following variables are defined in the main training script:
-whole_dataset, batch_size, train_split_percent, device, learning_rate, weight_decay, num_epochs, latent_dims, kl_weight, stochastic, etc.'''
-
-# train-val split
-n_train = int(train_split_percent * len(whole_dataset))
-n_val = len(whole_dataset) - n_train
-train_subset, val_subset = random_split(whole_dataset, [n_train, n_val], generator=torch.Generator().manual_seed(0))
+whole_dataset, batch_size, train_split_percent, device, learning_rate, weight_decay, num_epochs, latent_dims, kl_weight, stochastic, etc.
+optional: augment (True -> random flips/rotations of every training batch, see augment.py), augment_seed,
+materialize_val (True -> the validation crops are copied once into their own contiguous crop store, see splits.py),
+shard_shuffle (True -> shuffle shard by shard within a buffer instead of fully random reads, see ShardShuffleSampler),
+prefetch (number of batches a background thread keeps ready, see PrefetchLoader; 0/unset -> no prefetching),
+batch_buffers (True -> batches are written into a few reused preallocated tensors instead of fresh ones, see
+WMAP.use_batch_buffers; only safe if nothing keeps a batch around for longer than a couple of steps),
+resolution_schedule (coarse-to-fine training, {first epoch: downsampling factor}, e.g. {1: 4, 2001: 2, 5001: 1};
+see experiment.train and WMAP.set_resolution)'''
+
+if isinstance(whole_dataset, IterableDataset):
+    # crops streamed from the sky maps (SkyMapCrops): fresh random crops for training, the tiling of a held-out set
+    # of map blocks (which no training crop overlaps) for validation
+    train_subset, val_subset = whole_dataset.split(1 - train_split_percent, seed=0)
+else:
+    # train-val split, persisted next to the dataset and shared by every model folder (see splits.py)
+    train_subset, val_subset = split_dataset(whole_dataset, train_split_percent, seed=0,
+                                             materialize_val=globals().get('materialize_val', False))
 
 if __name__ == '__main__':
     print(f"Train dataset size: {len(train_subset)} | Validation dataset size: {len(val_subset)}")
     print(f"Image size: {train_subset[0].shape}")
 
 # create train and validation/test dataloaders
-train_loader = DataLoader(dataset=train_subset, batch_size=batch_size, shuffle=True)
-val_loader = DataLoader(dataset=val_subset, batch_size=batch_size, shuffle=False)
-
-img_size = train_subset[0].shape[0] * train_subset[0].shape[1]
+if getattr(whole_dataset, 'preload', False):
+    # batches are gathered straight from the preloaded tensor
+    train_loader = TensorLoader(train_subset, batch_size=batch_size, shuffle=True)
+    val_loader = TensorLoader(val_subset, batch_size=batch_size, shuffle=False)
+elif isinstance(train_subset, IterableDataset):
+    # streamed datasets do their own shuffling
+    train_loader = DataLoader(dataset=train_subset, batch_size=batch_size, collate_fn=collate_batch)
+    val_loader = DataLoader(dataset=val_subset, batch_size=batch_size, collate_fn=collate_batch)
+else:
+    # collate_batch passes through the (B, 1, H, W) tensors built by WMAP.__getitems__
+    if globals().get('batch_buffers', False) and hasattr(whole_dataset, 'use_batch_buffers'):
+        # written into reused buffers; room for the prefetched batches, the one in use and the one being read
+        whole_dataset.use_batch_buffers(count=globals().get('prefetch', 0) + 3)
+    sampler = ShardShuffleSampler(train_subset) if globals().get('shard_shuffle', False) else None
+    train_loader = DataLoader(dataset=train_subset, batch_size=batch_size, shuffle=sampler is None, sampler=sampler,
+                              collate_fn=collate_batch)
+    val_loader = DataLoader(dataset=val_subset, batch_size=batch_size, shuffle=False, collate_fn=collate_batch)
+
+if globals().get('augment', False):
+    # validation stays un-augmented so its loss is comparable across runs
+    # a run resumed from the checkpoint of epoch N continues with the transforms of epoch N + 1
+    train_loader = AugmentedLoader(train_loader, DihedralAugment(seed=globals().get('augment_seed', 0)),
+                                   start_epoch=globals().get('resume_from_epoch') or 0)
+
+if globals().get('prefetch', 0):
+    # outermost, so augmentation also runs in the background
+    train_loader = PrefetchLoader(train_loader, depth=prefetch)
+    val_loader = PrefetchLoader(val_loader, depth=prefetch)
+
+img_size = train_subset[0].shape[-2] * train_subset[0].shape[-1]
 
 model = ConvVAE(
+    image_channels=getattr(whole_dataset, 'channels', 1),  # > 1 for multi-band datasets
     stochastic=stochastic,
     latent_dim=latent_dim
     ).to(device)
@@ -49,7 +91,8 @@ if __name__ == '__main__':
     nnet.train(resume_timestamp=resume_timestamp, resume_from_epoch=resume_from_epoch,
                optimizer=optimizer, anneal=anneal, epochs=num_epochs, 
                kl_weight=0 if not stochastic else kl_weight,
-               save_every_n_epochs=save_every_n_epochs)
+               save_every_n_epochs=save_every_n_epochs,
+               resolution_schedule=globals().get('resolution_schedule'))
     # nnet.evaluate()
 
     # print(f"Selected latent dimensions: {latent_dims}")
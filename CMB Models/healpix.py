@@ -0,0 +1,242 @@
+import argparse
+import numpy as np
+from astropy.io import fits
+
+'''
+Vectorized numpy HEALPix indexing for NESTED maps (the native pixelization of the WMAP sky maps,
+e.g. wmap_band_imap_r9_9yr_K_v5.fits: nside 512, NESTED), without healpy.
+
+A NESTED pixel index is face * nside^2 + the bit-interleaved (x, y) position of the pixel on its base face
+(x in the even bits, y in the odd bits). Every aligned 2^k x 2^k block of a face is therefore a contiguous run of
+4^k indices, which is what HealpixPatches (datasets.py) reshapes into square patches.
+Angles are colatitude theta in [0, pi] and longitude phi in [0, 2 pi), in radians, as in healpy.
+
+usage (from the CMB Models folder; compares every function against healpy, skipped if healpy isn't installed):
+    python healpix.py --max-nside 512
+'''
+
+# UNSEEN value of healpy/WMAP maps for unobserved pixels
+UNSEEN = -1.6375e30
+
+# ring number (in units of nside) of the southernmost corner, and longitude index, of each base face
+JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+# neighbour order SW, W, NW, N, NE, E, SE, S (as healpy.get_all_neighbours)
+X_OFFSET = np.array([-1, -1, 0, 1, 1, 1, 0, -1])
+Y_OFFSET = np.array([0, 1, 1, 1, 0, -1, -1, -1])
+# face across the edge/corner the offset leaves through ([direction][face], -1: no neighbour there), and how the
+# (x, y) coordinates transform into that face ([direction][face // 4]: bit 1 flip x, bit 2 flip y, bit 4 swap)
+FACE_ARRAY = np.array([[8, 9, 10, 11, -1, -1, -1, -1, 10, 11, 8, 9],   # S
+                       [5, 6, 7, 4, 8, 9, 10, 11, 9, 10, 11, 8],       # SE
+                       [-1, -1, -1, -1, 5, 6, 7, 4, -1, -1, -1, -1],   # E
+                       [4, 5, 6, 7, 11, 8, 9, 10, 11, 8, 9, 10],       # SW
+                       [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11],         # same face
+                       [1, 2, 3, 0, 0, 1, 2, 3, 5, 6, 7, 4],           # NE
+                       [-1, -1, -1, -1, 7, 4, 5, 6, -1, -1, -1, -1],   # W
+                       [3, 0, 1, 2, 3, 0, 1, 2, 4, 5, 6, 7],           # NW
+                       [2, 3, 0, 1, -1, -1, -1, -1, 0, 1, 2, 3]])      # N
+SWAP_ARRAY = np.array([[0, 0, 3], [0, 0, 6], [0, 0, 0], [0, 0, 5], [0, 0, 0], [5, 0, 0], [0, 0, 0], [6, 0, 0],
+                       [3, 0, 0]])
+
+
+def nside2npix(nside):
+    return 12 * nside * nside
+
+
+def npix2nside(npix):
+    nside = int(round(np.sqrt(npix / 12)))
+    if nside2npix(nside) != npix:
+        raise ValueError(f'{npix} is not a valid number of HEALPix pixels')
+    return nside
+
+
+def nside2order(nside):
+    order = int(nside).bit_length() - 1
+    if nside < 1 or 1 << order != nside:
+        raise ValueError(f'NESTED ordering needs a power of 2 nside, got {nside}')
+    return order
+
+
+def spread_bits(v):
+    # bits b of v -> bits 2b
+    v = np.asarray(v, dtype=np.int64)
+    out = np.zeros_like(v)
+    for bit in range(30):
+        out |= ((v >> bit) & 1) << (2 * bit)
+    return out
+
+
+def compress_bits(v):
+    # bits 2b of v -> bits b
+    v = np.asarray(v, dtype=np.int64)
+    out = np.zeros_like(v)
+    for bit in range(30):
+        out |= ((v >> (2 * bit)) & 1) << bit
+    return out
+
+
+def nest2xyf(nside, ipix):
+    '''(x, y, face) of NESTED pixels.'''
+    ipix = np.asarray(ipix, dtype=np.int64)
+    face, local = np.divmod(ipix, nside * nside)
+    return compress_bits(local), compress_bits(local >> 1), face
+
+
+def xyf2nest(nside, x, y, face):
+    return np.asarray(face, dtype=np.int64) * nside * nside + spread_bits(x) + (spread_bits(y) << 1)
+
+
+def pix2ang(nside, ipix):
+    '''(theta, phi) in radians of the centres of NESTED pixels.'''
+    nside2order(nside)
+    x, y, face = nest2xyf(nside, ipix)
+    fact2 = 4 / nside2npix(nside)
+    fact1 = 2 * nside * fact2
+    # ring index counted from the north pole, 1..4 nside - 1
+    jr = JRLL[face] * nside - x - y - 1
+    north, south = jr < nside, jr > 3 * nside
+    nr = np.where(north, jr, np.where(south, 4 * nside - jr, nside))
+    z = np.where(north, 1 - nr * nr * fact2, np.where(south, nr * nr * fact2 - 1, (2 * nside - jr) * fact1))
+    tmp = JPLL[face] * nr + x - y
+    tmp = np.where(tmp < 0, tmp + 8 * nr, tmp)
+    phi = np.where(nr == nside, 0.75 * np.pi / 2 * tmp * fact1, 0.5 * np.pi / 2 * tmp / np.maximum(nr, 1))
+    return np.arccos(np.clip(z, -1, 1)), phi
+
+
+def ang2pix(nside, theta, phi):
+    '''NESTED pixels containing the directions (theta, phi) in radians.'''
+    order = nside2order(nside)
+    z = np.cos(np.asarray(theta, dtype=np.float64))
+    za = np.abs(z)
+    tt = np.mod(np.asarray(phi, dtype=np.float64) / (np.pi / 2), 4)  # in [0, 4)
+    z, za, tt = np.broadcast_arrays(z, za, tt)
+
+    # equatorial region, |z| <= 2/3
+    temp1 = nside * (0.5 + tt)
+    temp2 = nside * z * 0.75
+    jp = (temp1 - temp2).astype(np.int64)  # index of the ascending edge line
+    jm = (temp1 + temp2).astype(np.int64)  # index of the descending edge line
+    ifp, ifm = jp >> order, jm >> order
+    face = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    x_eq, y_eq = jm & (nside - 1), nside - (jp & (nside - 1)) - 1
+
+    # polar caps
+    ntt = np.minimum(3, tt.astype(np.int64))
+    tp = tt - ntt
+    tmp = nside * np.sqrt(3 * (1 - za))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z >= 0
+    x_pole = np.where(north, nside - jm - 1, jp)
+    y_pole = np.where(north, nside - jp - 1, jm)
+    face_pole = np.where(north, ntt, ntt + 8)
+
+    equatorial = za <= 2 / 3
+    return xyf2nest(nside, np.where(equatorial, x_eq, x_pole), np.where(equatorial, y_eq, y_pole),
+                    np.where(equatorial, face, face_pole))
+
+
+def neighbours(nside, ipix):
+    '''
+    (8, N) NESTED indices of the SW, W, NW, N, NE, E, SE and S neighbours of each pixel, -1 where a pixel has only
+    7 neighbours (the W/E or N/S neighbour at the 8 corners where three base faces meet).
+    '''
+    ipix = np.asarray(ipix, dtype=np.int64)
+    x, y, face = nest2xyf(nside, ipix.ravel())
+    x = x[None, :] + X_OFFSET[:, None]
+    y = y[None, :] + Y_OFFSET[:, None]
+    # which face the neighbour is on, relative to the pixel's face (4 = same face)
+    direction = 4 + np.where(x < 0, -1, np.where(x >= nside, 1, 0)) + np.where(y < 0, -3, np.where(y >= nside, 3, 0))
+    x, y = np.mod(x, nside), np.mod(y, nside)
+    face = np.broadcast_to(face, direction.shape)
+    neighbour_face = FACE_ARRAY[direction, face]
+    bits = SWAP_ARRAY[direction, face >> 2]
+    x = np.where(bits & 1, nside - x - 1, x)
+    y = np.where(bits & 2, nside - y - 1, y)
+    x, y = np.where(bits & 4, y, x), np.where(bits & 4, x, y)
+    result = np.where(neighbour_face >= 0, xyf2nest(nside, x, y, np.maximum(neighbour_face, 0)), -1)
+    return result.reshape(8, *ipix.shape)
+
+
+def ud_grade(nested_map, nside_out):
+    '''
+    NESTED map (or (..., npix) stack of maps) at another resolution: downgrading averages the 4^k sub-pixels of
+    every output pixel (ignoring NaN / UNSEEN ones; NaN if all are), upgrading repeats every pixel 4^k times.
+    '''
+    nested_map = np.asarray(nested_map)
+    nside_in = npix2nside(nested_map.shape[-1])
+    order_in, order_out = nside2order(nside_in), nside2order(nside_out)
+    if order_out >= order_in:
+        return np.repeat(nested_map, 4 ** (order_out - order_in), axis=-1)
+    blocks = nested_map.reshape(*nested_map.shape[:-1], nside2npix(nside_out), 4 ** (order_in - order_out))
+    blocks = np.where(blocks <= UNSEEN / 2, np.nan, blocks.astype(np.float64))
+    valid = ~np.isnan(blocks)
+    total = np.where(valid, blocks, 0).sum(axis=-1)
+    count = valid.sum(axis=-1)
+    with np.errstate(invalid='ignore'):
+        return (total / count).astype(np.float32 if nested_map.dtype == np.float32 else np.float64)
+
+
+def block_order(size):
+    # (size, size) NESTED offsets of the pixels of an aligned size x size block, indexed [x, y]
+    coords = np.arange(size)
+    return spread_bits(coords)[:, None] + (spread_bits(coords)[None, :] << 1)
+
+
+def read_healpix_map(path, field=0, hdu=1):
+    '''
+    (map, nside) of a HEALPix FITS map in NESTED ordering (binary table, e.g. the TEMPERATURE column of the WMAP
+    wmap_band_imap_* files); UNSEEN pixels become NaN.
+    '''
+    with fits.open(path, memmap=True) as hdul:
+        header = hdul[hdu].header
+        ordering = str(header.get('ORDERING', 'NESTED')).strip().upper()
+        if ordering != 'NESTED':
+            raise ValueError(f"'{path}' is in {ordering} ordering, only NESTED maps are supported")
+        values = np.asarray(hdul[hdu].data.field(field), dtype=np.float32).ravel()
+    values[values <= UNSEEN / 2] = np.nan
+    nside = int(header.get('NSIDE', npix2nside(len(values))))
+    if nside2npix(nside) != len(values):
+        raise ValueError(f"'{path}' has {len(values)} pixels, expected {nside2npix(nside)} for nside {nside}")
+    return values, nside
+
+
+def compare_with_healpy(max_nside=512, n_points=100000, seed=0):
+    # pix2ang, ang2pix, neighbours and ud_grade against healpy for nside 1, 2, 4, ..., max_nside; False on mismatch
+    import healpy
+    rng = np.random.default_rng(seed)
+    ok = True
+    nside = 1
+    while nside <= max_nside:
+        npix = nside2npix(nside)
+        ipix = np.arange(npix) if npix <= n_points else rng.integers(0, npix, n_points)
+        theta = np.arccos(rng.uniform(-1, 1, n_points))
+        phi = rng.uniform(0, 2 * np.pi, n_points)
+        values = rng.standard_normal(npix)
+        checks = {'pix2ang': np.allclose(pix2ang(nside, ipix), healpy.pix2ang(nside, ipix, nest=True),
+                                         rtol=0, atol=1e-12),
+                  'ang2pix': np.array_equal(ang2pix(nside, theta, phi), healpy.ang2pix(nside, theta, phi, nest=True)),
+                  'neighbours': np.array_equal(neighbours(nside, ipix),
+                                               healpy.get_all_neighbours(nside, ipix, nest=True))}
+        if nside > 1:
+            checks['ud_grade'] = np.allclose(ud_grade(values, nside // 2),
+                                             healpy.ud_grade(values, nside // 2, order_in='NESTED'))
+        failed = [name for name, passed in checks.items() if not passed]
+        print(f"nside {nside}: {'mismatch in ' + ', '.join(failed) if failed else 'all agree'}")
+        ok = ok and not failed
+        nside *= 2
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the HEALPix functions of healpix.py against healpy.')
+    parser.add_argument('--max-nside', type=int, default=512, help='largest nside to compare (power of 2)')
+    args = parser.parse_args()
+    try:
+        import healpy
+    except ImportError:
+        print('healpy is not installed, skipping the comparison')
+    else:
+        print(f'Comparing against healpy {healpy.__version__}')
+        raise SystemExit(0 if compare_with_healpy(args.max_nside) else 1)
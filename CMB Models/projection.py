@@ -0,0 +1,204 @@
+import os
+import json
+import numpy as np
+
+'''
+Lookup tables of the Mollweide projection of the WMAP sky map images (wmap_mollweide_imap_*), so pixel <-> sky
+conversions are table lookups instead of trigonometry per crop or per pixel.
+
+The image is the full-sky Mollweide ellipse inscribed in the (H, W) pixel grid, centred on (l, b) = (0, 0), in
+galactic coordinates. Orientation follows the FITS header signs of CDELT1/CDELT2 (default -1, +1: longitude grows to
+the left, row 0 is the southern edge).
+
+cached per resolution and orientation (see MollweideProjection):
+    <cache_dir>/mollweide-<H>x<W>[-<signs>]/l.npy        - (H, W) float32 galactic longitude of every pixel centre
+                                                           in degrees [0, 360), NaN outside the ellipse
+    <cache_dir>/mollweide-<H>x<W>[-<signs>]/b.npy        - (H, W) float32 galactic latitude in degrees, NaN outside
+    <cache_dir>/mollweide-<H>x<W>[-<signs>]/valid.npy    - (H, W) bool, pixel centre inside the projection ellipse
+    <cache_dir>/mollweide-<H>x<W>[-<signs>]/latitude.npy - (N, 3) float64 latitude -> (sin theta, cos theta) of the
+                                                           auxiliary angle, for the sky -> pixel direction
+    <cache_dir>/mollweide-<H>x<W>[-<signs>]/meta.json    - shape and signs (written last)
+'''
+
+TABLE_FILES = ('l.npy', 'b.npy', 'valid.npy', 'latitude.npy')
+META_FILE = 'meta.json'
+
+# latitude step of the sky -> pixel table: interpolation error is far below a pixel at WMAP resolutions
+LATITUDE_STEP = 0.01
+
+
+def auxiliary_angle(latitude, iterations=50):
+    # theta of the Mollweide projection, solving 2 theta + sin(2 theta) = pi sin(latitude) by Newton's method
+    # (vectorized; only run when the tables are built)
+    target = np.pi * np.sin(latitude)
+    theta = np.asarray(latitude, dtype=np.float64).copy()
+    for _ in range(iterations):
+        denominator = 2 + 2 * np.cos(2 * theta)
+        step = np.divide(2 * theta + np.sin(2 * theta) - target, denominator,
+                         out=np.zeros_like(theta), where=denominator > 1e-12)
+        theta -= step
+        if np.max(np.abs(step)) < 1e-12:
+            break
+    return theta
+
+
+def mollweide_sky(shape, x_sign=-1, y_sign=1):
+    '''(l, b, valid) of every pixel centre of an (H, W) Mollweide image, computed over the whole grid at once.'''
+    H, W = shape
+    # normalized projection plane coordinates: the ellipse is u^2 + v^2 <= 1
+    u = (np.arange(W) + 0.5) / W * 2 - 1
+    v = (np.arange(H) + 0.5) / H * 2 - 1
+    u, v = np.meshgrid(u, v)
+    valid = u ** 2 + v ** 2 <= 1
+    theta = np.arcsin(np.clip(v, -1, 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        longitude = np.degrees(np.pi * u / np.cos(theta))
+    latitude = np.degrees(np.arcsin(np.clip((2 * theta + np.sin(2 * theta)) / np.pi, -1, 1)))
+    with np.errstate(invalid='ignore'):
+        l = np.where(valid, np.mod(x_sign * longitude, 360), np.nan)
+    b = np.where(valid, y_sign * latitude, np.nan)
+    return l.astype(np.float32), b.astype(np.float32), valid
+
+
+def latitude_table(step=LATITUDE_STEP):
+    latitude = np.arange(-90, 90 + step / 2, step)
+    theta = auxiliary_angle(np.radians(latitude))
+    return np.column_stack([latitude, np.sin(theta), np.cos(theta)])
+
+
+class MollweideProjection:
+    '''
+    Pixel <-> galactic coordinate tables of an (H, W) Mollweide image. cache_dir: directory the tables are
+    memory-mapped from (built there once per resolution and orientation); None -> computed in memory.
+    '''
+    def __init__(self, shape, cache_dir=None, x_sign=-1, y_sign=1):
+        self.shape = tuple(shape)
+        self.x_sign = -1 if x_sign < 0 else 1
+        self.y_sign = -1 if y_sign < 0 else 1
+        if cache_dir is None:
+            self.l, self.b, self.valid = mollweide_sky(self.shape, self.x_sign, self.y_sign)
+            self.latitude = latitude_table()
+        else:
+            self.path = os.path.join(cache_dir, self.table_name())
+            if not self.cached():
+                self.build()
+            self.l, self.b, self.valid, self.latitude = (np.load(os.path.join(self.path, f), mmap_mode='r')
+                                                         for f in TABLE_FILES)
+
+    def table_name(self):
+        # the default orientation keeps the plain name
+        signs = '' if (self.x_sign, self.y_sign) == (-1, 1) else f'-{self.x_sign:+d}{self.y_sign:+d}'
+        return f'mollweide-{self.shape[0]}x{self.shape[1]}{signs}'
+
+    def cached(self):
+        try:
+            with open(os.path.join(self.path, META_FILE)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return False
+        return meta == {'shape': list(self.shape), 'signs': [self.x_sign, self.y_sign]}
+
+    def build(self):
+        os.makedirs(self.path, exist_ok=True)
+        meta_path = os.path.join(self.path, META_FILE)
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+        for name, table in zip(TABLE_FILES, (*mollweide_sky(self.shape, self.x_sign, self.y_sign), latitude_table())):
+            tmp_path = os.path.join(self.path, name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.save(f, table)
+            os.replace(tmp_path, os.path.join(self.path, name))
+        with open(meta_path, 'w') as f:
+            json.dump({'shape': list(self.shape), 'signs': [self.x_sign, self.y_sign]}, f)
+
+    def pixel_to_sky(self, ys, xs):
+        # (l, b) in degrees of the given pixels (NaN outside the ellipse), a lookup
+        return self.l[ys, xs], self.b[ys, xs]
+
+    def crop_centers(self, ys, xs, size):
+        # (l, b) of the centre pixel of (size x size) crops with top-left corners (ys, xs)
+        return self.pixel_to_sky(np.asarray(ys) + size // 2, np.asarray(xs) + size // 2)
+
+    def sky_to_pixel(self, l, b):
+        '''
+        Fractional (row, col) pixel coordinates (pixel centres at integers) of galactic (l, b) in degrees.
+        The auxiliary angle comes from the latitude table, so this is interpolation instead of Newton's method.
+        '''
+        longitude = np.mod(self.x_sign * np.asarray(l, dtype=np.float64) + 180, 360) - 180
+        latitude = self.y_sign * np.asarray(b, dtype=np.float64)
+        sin_theta = np.interp(latitude, self.latitude[:, 0], self.latitude[:, 1])
+        cos_theta = np.interp(latitude, self.latitude[:, 0], self.latitude[:, 2])
+        u = longitude / 180 * cos_theta
+        H, W = self.shape
+        return (sin_theta + 1) / 2 * H - 0.5, (u + 1) / 2 * W - 0.5
+
+
+def fill_outside_ellipse(image, valid):
+    # image with every pixel outside the projection ellipse set to the nearest valid pixel of its row, so bilinear
+    # sampling next to the ellipse edge (narrow near the poles) doesn't blend in the empty corners
+    valid = np.asarray(valid)
+    first = valid.argmax(axis=1)
+    last = valid.shape[1] - 1 - valid[:, ::-1].argmax(axis=1)
+    cols = np.clip(np.arange(valid.shape[1])[None, :], first[:, None], last[:, None])
+    return np.asarray(image)[np.arange(valid.shape[0])[:, None], cols]
+
+
+def gnomonic_offsets(size, resolution, x_sign=-1, y_sign=1):
+    '''
+    (xi, eta) tangent-plane coordinates in radians of the pixel centres of a (size x size) patch with `resolution`
+    degrees per pixel, oriented like the map (x_sign/y_sign as in MollweideProjection) so patches look like crops.
+    '''
+    offsets = (np.arange(size) - (size - 1) / 2) * np.radians(resolution)
+    eta, xi = np.meshgrid(y_sign * offsets, x_sign * offsets, indexing='ij')
+    return xi, eta
+
+
+def gnomonic_sky(l, b, xi, eta):
+    '''
+    Galactic (l, b) in degrees of the tangent-plane points (xi, eta) (see gnomonic_offsets) of gnomonic patches
+    centred on (l[i], b[i]): (N, *xi.shape) arrays, vectorized over all patches at once.
+    '''
+    l0, b0 = (np.radians(np.asarray(values, dtype=np.float64))[:, None, None] for values in (l, b))
+    rho = np.hypot(xi, eta)
+    c = np.arctan(rho)
+    # sin(c) / rho -> 1 at the patch centre
+    sin_c = np.divide(np.sin(c), rho, out=np.ones_like(rho), where=rho > 0)
+    latitude = np.arcsin(np.cos(c) * np.sin(b0) + eta * sin_c * np.cos(b0))
+    longitude = l0 + np.arctan2(xi * sin_c, np.cos(b0) * np.cos(c) - eta * sin_c * np.sin(b0))
+    return np.mod(np.degrees(longitude), 360), np.degrees(latitude)
+
+
+def sky_centers(spacing, min_abs_b=0):
+    '''
+    (l, b) in degrees of a near-uniform set of sky positions about `spacing` degrees apart (Fibonacci lattice),
+    optionally without the galactic band |b| < min_abs_b.
+    '''
+    n = max(1, int(round(4 * np.pi / np.radians(spacing) ** 2)))
+    i = np.arange(n)
+    b = np.degrees(np.arcsin(1 - 2 * (i + 0.5) / n))
+    l = np.mod(i * 180 * (3 - np.sqrt(5)), 360)
+    keep = np.abs(b) >= min_abs_b
+    return l[keep], b[keep]
+
+
+def stitch_crops(crops, ys, xs, shape, valid=None):
+    '''
+    Places (N, size, size) crops (e.g. reconstructions) back at their top-left corners (ys, xs) of an (H, W) map,
+    averaging overlapping crops; pixels no crop covers and pixels outside `valid` (e.g. MollweideProjection.valid)
+    are NaN.
+    '''
+    crops = np.asarray(crops, dtype=np.float32)
+    size = crops.shape[-1]
+    offsets = np.arange(size)
+    rows, cols = np.broadcast_arrays(np.asarray(ys)[:, None, None] + offsets[None, :, None],
+                                     np.asarray(xs)[:, None, None] + offsets[None, None, :])
+    rows, cols = rows.ravel(), cols.ravel()
+    total = np.zeros(shape, dtype=np.float64)
+    count = np.zeros(shape, dtype=np.int32)
+    np.add.at(total, (rows, cols), crops.reshape(-1))
+    np.add.at(count, (rows, cols), 1)
+    with np.errstate(invalid='ignore'):
+        stitched = (total / count).astype(np.float32)
+    if valid is not None:
+        stitched[~np.asarray(valid)] = np.nan
+    return stitched
@@ -0,0 +1,237 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from astropy.io import fits
+
+from projection import MollweideProjection
+
+'''
+Access to the WMAP sky map images (wmap_mollweide_imap_r9_yr*_*_v5.fits, image in HDU 1) for cutting crops
+at runtime instead of reading pre-cut crop directories.
+
+Map cache: the first access to a map's image HDU converts it once into (see cached_map)
+    <map folder>/map_cache/<map>-<hash>-hdu<n>.npy     - the image as float32, NaNs replaced by 0
+                                                         (like the notebooks' np.nan_to_num(data.astype(float)))
+    <map folder>/map_cache/<map>-<hash>-hdu<n>.nan.npy - boolean mask of the pixels that were NaN
+keyed by the map's content hash; every later access is a read-only memory map, with no decoding or conversion.
+The content hashes themselves are kept next to the cache (see file_hash), so new processes don't re-read the maps:
+    <map folder>/map_cache/<map file name>.sha1.json   - sha1 of the file and the (path, size, mtime) it belongs to
+'''
+
+MAP_CACHE_DIR = 'map_cache'
+
+# content hash of every map file seen by this process, by (path, size, mtime)
+_hashes = {}
+
+
+class SkyMap:
+    def __init__(self, path, hdu=1, cache=True, cache_dir=None):
+        '''
+        cache = True  -> the image is served from the float32 map cache (see cached_map): NaNs already zeroed
+                False -> the FITS file is opened and the pixel HDU stays memory-mapped as stored
+        Either way crops only touch the pages they cover.
+        '''
+        self.path = path
+        self.hdu = hdu
+        self.hdul = None
+        self.nan_mask = None
+        if cache:
+            self.data, self.nan_mask = cached_map(path, hdu, cache_dir)
+        else:
+            self.hdul = fits.open(path, memmap=True)
+            self.data = self.hdul[hdu].data
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def header(self):
+        return self.hdul[self.hdu].header if self.hdul is not None else fits.getheader(self.path, self.hdu)
+
+    def crops(self, ys, xs, size):
+        # all (size x size) crops with top-left corners (ys[i], xs[i]) in one fancy-indexed read,
+        # as float32 with NaNs zeroed like the notebooks' np.nan_to_num(data.astype(float))
+        offsets = np.arange(size)
+        rows = np.asarray(ys)[:, None, None] + offsets[None, :, None]
+        cols = np.asarray(xs)[:, None, None] + offsets[None, None, :]
+        crops = self.data[rows, cols]
+        if self.nan_mask is None:
+            crops = np.nan_to_num(crops.astype(np.float32), copy=False)
+        return crops
+
+    def valid_pixels(self):
+        # pixels with data: the WMAP Mollweide maps are NaN outside the projection ellipse
+        return ~self.nan_mask if self.nan_mask is not None else ~np.isnan(self.data)
+
+    def projection(self, cache_dir=None):
+        '''
+        Pixel <-> galactic coordinate tables of the map (see projection.py), oriented like the header's CDELT1/CDELT2
+        and cached in cache_dir (default: the map's folder, shared by every map of the same resolution).
+        '''
+        header = self.header
+        x_sign, y_sign = header.get('CDELT1', -1), header.get('CDELT2', 1)
+        try:
+            return MollweideProjection(self.shape, cache_dir or os.path.dirname(os.path.abspath(self.path)),
+                                       x_sign, y_sign)
+        except OSError:
+            # read-only map folder: the tables are only a second to compute
+            return MollweideProjection(self.shape, None, x_sign, y_sign)
+
+    def close(self):
+        if self.hdul is not None:
+            self.hdul.close()
+
+
+class SkyMapPool:
+    '''
+    Opens SkyMaps on first use and keeps them open. Only maps read straight from their FITS file (cache=False) hold
+    a file handle: at most max_open of those stay open (least recently used one closed first, default: all of them),
+    for datasets that read from more maps (e.g. nine yearly maps) than should hold FITS handles at once.
+    Maps served from the map cache are plain memory maps and are never closed.
+    '''
+    def __init__(self, paths, hdu=1, max_open=None, cache=True):
+        self.paths = list(paths)
+        self.hdu = hdu
+        self.max_open = max_open or len(self.paths)
+        self.cache = cache
+        self.open_maps = OrderedDict()
+
+    def __getitem__(self, i):
+        if i in self.open_maps:
+            self.open_maps.move_to_end(i)
+        else:
+            sky_map = SkyMap(self.paths[i], self.hdu, cache=self.cache)
+            if sky_map.hdul is not None:
+                handles = [j for j, open_map in self.open_maps.items() if open_map.hdul is not None]
+                if len(handles) >= self.max_open:
+                    self.open_maps.pop(handles[0]).close()
+            self.open_maps[i] = sky_map
+        return self.open_maps[i]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def close(self):
+        for sky_map in self.open_maps.values():
+            sky_map.close()
+        self.open_maps.clear()
+
+    def __getstate__(self):
+        # open FITS files don't pickle, DataLoader workers re-open the maps they read
+        state = self.__dict__.copy()
+        state['open_maps'] = OrderedDict()
+        return state
+
+
+def tile_positions(shape, size, stride=None, mask=None):
+    '''
+    top-left corners of every full (size x size) tile of a (H, W) image, row by row.
+    mask: optional boolean (H, W) array of valid pixels; tiles containing any invalid pixel are left out
+    (counted for all tiles at once with a summed-area table, without cutting any tile).
+    '''
+    stride = stride or size
+    ys = np.arange(0, shape[0] - size + 1, stride)
+    xs = np.arange(0, shape[1] - size + 1, stride)
+    ys, xs = np.meshgrid(ys, xs, indexing='ij')
+    ys, xs = ys.ravel(), xs.ravel()
+    if mask is not None:
+        invalid = np.pad(np.cumsum(np.cumsum(~np.asarray(mask, dtype=bool), axis=0), axis=1), ((1, 0), (1, 0)))
+        n_invalid = invalid[ys + size, xs + size] - invalid[ys, xs + size] - invalid[ys + size, xs] + invalid[ys, xs]
+        ys, xs = ys[n_invalid == 0], xs[n_invalid == 0]
+    return ys, xs
+
+
+def holdout_blocks(shape, block_size, fraction, seed=0):
+    '''
+    boolean (H, W) mask of a held-out region: a random `fraction` of the (block_size x block_size) blocks of the
+    image (at least one), e.g. for validating on parts of the sky the training crops never touch.
+    '''
+    rows, cols = -(-shape[0] // block_size), -(-shape[1] // block_size)
+    n_held = max(1, int(round(fraction * rows * cols)))
+    blocks = np.zeros(rows * cols, dtype=bool)
+    blocks[np.random.default_rng(seed).permutation(rows * cols)[:n_held]] = True
+    blocks = blocks.reshape(rows, cols)
+    return np.repeat(np.repeat(blocks, block_size, axis=0), block_size, axis=1)[:shape[0], :shape[1]]
+
+
+def load_mask(mask):
+    # boolean (H, W) array of valid pixels, from an array or the path of a .npy file
+    return None if mask is None else np.asarray(np.load(mask) if isinstance(mask, str) else mask, dtype=bool)
+
+
+def valid_pixels(sky_map, mask=None, mask_nan=False):
+    # combined pixel mask of a map: the given mask and/or the map's own NaNs (None -> every pixel is valid)
+    if mask_nan:
+        return sky_map.valid_pixels() if mask is None else mask & sky_map.valid_pixels()
+    return mask
+
+
+def file_hash(path, block_size=1 << 20, cache_dir=None):
+    '''
+    content hash of a (map or mask) file, so cached products are keyed by what is in the file, not its name/mtime.
+    The file is only read when its (path, size, mtime) changed: the digest is memoized per process and saved in
+    cache_dir (default <file folder>/map_cache) for every later process.
+    '''
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key in _hashes:
+        return _hashes[key]
+    cache_dir = cache_dir or os.path.join(os.path.dirname(key[0]), MAP_CACHE_DIR)
+    record_path = os.path.join(cache_dir, os.path.basename(path) + '.sha1.json')
+    try:
+        with open(record_path) as f:
+            record = json.load(f)
+        if tuple(record['key']) == key:
+            _hashes[key] = record['sha1']
+            return _hashes[key]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    _hashes[key] = digest.hexdigest()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{record_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': list(key), 'sha1': _hashes[key]}, f)
+        os.replace(tmp_path, record_path)
+    except OSError:
+        pass  # read-only folder: hashed again by the next process
+    return _hashes[key]
+
+
+def cached_map(path, hdu=1, cache_dir=None):
+    '''
+    (image, nan_mask) of a FITS image HDU as read-only memory maps of the map cache: a float32 image with NaNs
+    replaced by 0 and a boolean mask of the NaN pixels. The cache entry is written on first access.
+    cache_dir: default <map folder>/map_cache; if it can't be written, the converted map is returned in memory.
+    '''
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), MAP_CACHE_DIR)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    base = os.path.join(cache_dir, f'{stem}-{file_hash(path, cache_dir=cache_dir)[:16]}-hdu{hdu}')
+    image_path, mask_path = base + '.npy', base + '.nan.npy'
+    if not os.path.isfile(mask_path):
+        with fits.open(path, memmap=True) as hdul:
+            if not hdul[hdu].is_image or hdul[hdu].data is None:
+                raise ValueError(f"HDU {hdu} of '{path}' is not an image")
+            image = np.asarray(hdul[hdu].data, dtype=np.float32)
+        nan_mask = np.isnan(image)
+        image = np.nan_to_num(image, copy=False) if nan_mask.any() else image
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # the mask is written last: a cache entry is complete once its mask exists
+            for target, array in ((image_path, image), (mask_path, nan_mask)):
+                tmp_path = f'{target}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp_path, target)
+        except OSError as e:
+            print(f"Could not write map cache '{base}': {e}")
+            image.flags.writeable = nan_mask.flags.writeable = False
+            return image, nan_mask
+    return np.load(image_path, mmap_mode='r'), np.load(mask_path, mmap_mode='r')
@@ -0,0 +1,129 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import Subset
+
+from crop_store import CROPS_FILE, INDEX_FILE
+
+'''
+Train/validation splits that are computed once and persisted next to the dataset, so every model folder,
+comparison.ipynb and every rerun use exactly the same validation crops.
+
+    <dataset>.split-<key>.npz       - 'train' and 'val' index arrays; the key covers the crop list, the train
+                                      fraction and the seed, so a changed dataset gets a new split
+    <dataset>.split-<key>.val.store - optional crop store holding just the validation crops, in order
+                                      (see split_dataset(materialize_val=True))
+
+The permutation is the one random_split(generator=torch.Generator().manual_seed(seed)) draws. Earlier runs drew it
+over the crops in os.listdir order, while WMAP now indexes them in sorted order: for a crop directory the split is
+drawn over the listdir order and mapped to the sorted indices, so it holds the same crops as those runs (as long as
+the directory, and the filesystem's listing order, are unchanged). Crop stores get the split of their sorted order.
+'''
+
+
+def dataset_fingerprint(dataset):
+    names = getattr(dataset, 'img_list', None)
+    if names is None:
+        return str(len(dataset))
+    return hashlib.sha1('\n'.join(names).encode()).hexdigest()
+
+
+def listdir_order(dataset):
+    # dataset indices of the crops in os.listdir order (how WMAP indexed a crop directory before its crop list
+    # was sorted), or None if the dataset isn't a directory listing exactly its crops
+    names = getattr(dataset, 'img_list', None)
+    dataset_path = getattr(dataset, 'dataset_path', None)
+    if names is None or dataset_path is None or not os.path.isdir(dataset_path):
+        return None
+    listed = [f for f in os.listdir(dataset_path) if os.path.isfile(os.path.join(dataset_path, f))]
+    position = {name: i for i, name in enumerate(names)}
+    if len(listed) != len(names) or any(name not in position for name in listed):
+        return None
+    return np.array([position[name] for name in listed])
+
+
+def split_path(dataset, train_fraction=0.8, seed=0):
+    # None for datasets that don't live on disk (nothing to put the split next to)
+    dataset_path = getattr(dataset, 'dataset_path', None)
+    if dataset_path is None:
+        return None
+    key = json.dumps([dataset_fingerprint(dataset), len(dataset), train_fraction, seed])
+    return f'{os.path.normpath(dataset_path)}.split-{hashlib.sha1(key.encode()).hexdigest()[:12]}.npz'
+
+
+def load_split(dataset, train_fraction=0.8, seed=0):
+    '''(train indices, val indices) of dataset, read from the persisted split or drawn and persisted once.'''
+    path = split_path(dataset, train_fraction, seed)
+    if path is not None and os.path.isfile(path):
+        with np.load(path) as split:
+            return split['train'], split['val']
+
+    n_train = int(train_fraction * len(dataset))
+    order = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(seed)).numpy()
+    legacy = listdir_order(dataset)
+    if legacy is not None:
+        order = legacy[order]
+    train, val = order[:n_train], order[n_train:]
+
+    if path is not None:
+        try:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, train=train, val=val)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write split '{path}': {e}")
+    return train, val
+
+
+def materialize_subset(dataset, indices, store_path, chunk_size=65536):
+    '''
+    Writes dataset[indices] (raw crops, in the given order) into a crop store, so the subset is read as
+    contiguous slices instead of scattered Subset lookups. Needs a dataset with get_batch/img_list (WMAP).
+    '''
+    if os.path.isfile(os.path.join(store_path, INDEX_FILE)):
+        return store_path
+    if not hasattr(dataset, 'get_batch') or getattr(dataset, 'img_list', None) is None:
+        raise ValueError('Materializing a subset needs a WMAP dataset')
+
+    first = np.asarray(dataset.get_batch(indices[:1]))
+    os.makedirs(store_path, exist_ok=True)
+    tmp_path = os.path.join(store_path, CROPS_FILE + '.tmp')
+    crops = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=first.dtype, shape=(len(indices), *first.shape[1:]))
+    for start in range(0, len(indices), chunk_size):
+        # reading the chunk in store order keeps the source reads sequential too
+        chunk = indices[start:start + chunk_size]
+        order = np.argsort(chunk, kind='stable')
+        crops[start + order] = dataset.get_batch(chunk[order])
+    crops.flush()
+    del crops
+    os.replace(tmp_path, os.path.join(store_path, CROPS_FILE))
+
+    index = {'names': [dataset.img_list[i] for i in indices],
+             'shape': [len(indices), *first.shape[1:]],
+             'dtype': first.dtype.str,
+             'source': os.path.abspath(dataset.dataset_path)}
+    with open(os.path.join(store_path, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+    return store_path
+
+
+def split_dataset(dataset, train_fraction=0.8, seed=0, materialize_val=False):
+    '''
+    (train subset, val subset) over the persisted split. materialize_val = True -> the validation subset is a
+    WMAP over its own contiguous crop store (written once, next to the split) with the dataset's settings.
+    '''
+    train, val = load_split(dataset, train_fraction, seed)
+    train_subset = Subset(dataset, train.tolist())
+    if not materialize_val:
+        return train_subset, Subset(dataset, val.tolist())
+
+    from datasets import WMAP
+    path = split_path(dataset, train_fraction, seed)
+    if path is None:
+        raise ValueError('Materializing the validation subset needs a dataset on disk (with a dataset_path)')
+    store_path = materialize_subset(dataset, val, path[:-len('.npz')] + '.val.store')
+    val_subset = WMAP(store_path, transform=dataset.transform, normalize=dataset.normalize, preload=dataset.preload)
+    return train_subset, val_subset